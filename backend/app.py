@@ -1,17 +1,37 @@
 import base64
+import bisect
+import contextvars
+import functools
+import hashlib
+import hmac
 import json
 import os
 import random
 import re
-from datetime import datetime, timedelta
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from io import BytesIO
 from zoneinfo import ZoneInfo
 
 import requests
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request
+from flask import Flask, g, jsonify, make_response, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     import firebase_admin
     from firebase_admin import credentials, firestore
@@ -33,18 +53,164 @@ GROQ_KEY_4 = os.getenv("GROQ_KEY_4")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
 CHAT_MODEL = "llama-3.3-70b-versatile"
+# Tăng mỗi khi system prompt chat thay đổi để cache câu trả lời cũ tự hết hiệu lực.
+CHAT_PROMPT_VERSION = "3"
 VISION_MODEL = "llama-3.2-11b-vision-preview"
 
 FALLBACK_MESSAGE = (
     "Đại ca ơi, khách đang đông quá em xử lý không kịp, đại ca đợi em vài giây nhé!"
 )
 
+UPSTREAM_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_TIMEOUT_SECONDS", "30"))
+MIN_UPSTREAM_TIMEOUT_SECONDS = float(os.getenv("MIN_UPSTREAM_TIMEOUT_SECONDS", "2"))
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "45"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_RECOVERY_SECONDS = float(os.getenv("BREAKER_RECOVERY_SECONDS", "30"))
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+EXTRACT_QUEUE_MAX = int(os.getenv("EXTRACT_QUEUE_MAX", "8"))
+EXTRACT_JOB_TTL_SECONDS = float(os.getenv("EXTRACT_JOB_TTL_SECONDS", "600"))
+EXTRACT_RETRY_AFTER_SECONDS = 5
+EXTRACT_MAX_WAIT_SECONDS = 25
+EXTRACT_MAX_JOBS_PER_USER = int(os.getenv("EXTRACT_MAX_JOBS_PER_USER", "2"))
+
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "12"))
+LLM_MAX_INFLIGHT_PER_USER = int(os.getenv("LLM_MAX_INFLIGHT_PER_USER", "2"))
+VISION_MAX_INFLIGHT = int(os.getenv("VISION_MAX_INFLIGHT", "4"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "3"))
+ADMISSION_RETRY_AFTER_SECONDS = 2
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH")
+
+IDEMPOTENCY_DB_PATH = os.getenv("IDEMPOTENCY_DB_PATH") or os.path.join(tempfile.gettempdir(), "kairo_idempotency.sqlite3")
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "5000"))
+IDEMPOTENCY_POLL_SECONDS = 0.2
+IDEMPOTENCY_REPLAY_HEADERS = ("Content-Type", "Location", "Retry-After")
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+KEY_TOKENS_PER_MINUTE = int(os.getenv("KEY_TOKENS_PER_MINUTE", "6000"))
+KEY_REQUESTS_PER_DAY = int(os.getenv("KEY_REQUESTS_PER_DAY", "1000"))
+KEY_PRESSURE_THRESHOLD = float(os.getenv("KEY_PRESSURE_THRESHOLD", "0.8"))
+USER_DAILY_TOKEN_LIMIT = int(os.getenv("USER_DAILY_TOKEN_LIMIT", "200000"))
+USER_DAILY_TOKEN_SOFT_LIMIT = int(os.getenv("USER_DAILY_TOKEN_SOFT_LIMIT", "100000"))
+DEFAULT_MAX_TOKENS = 1000
+SHORT_REPLY_MAX_TOKENS = 600
+
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED", "0") == "1"
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", "21600"))
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "2000"))
+CHAT_CACHE_MAX_MESSAGE_CHARS = 160
+
+VISION_MAX_IMAGE_BYTES = int(os.getenv("VISION_MAX_IMAGE_BYTES", str(4 * 1024 * 1024)))
+# Chừa thêm chỗ cho header multipart; Flask từ chối 413 trước khi đọc body nếu vượt quá.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(VISION_MAX_IMAGE_BYTES + 256 * 1024)))
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
 VN_TZ = ZoneInfo("Asia/Ho_Chi_Minh")
+WEEKDAY_NAMES = ("Thứ 2", "Thứ 3", "Thứ 4", "Thứ 5", "Thứ 6", "Thứ 7", "Chủ nhật")
+CONFLICT_WINDOW_MINUTES = 5
+MAX_CONFLICT_WARNINGS = 3
+OCCURRENCE_WINDOW_DAYS = int(os.getenv("OCCURRENCE_WINDOW_DAYS", "14"))
+OCCURRENCE_CACHE_MAX_USERS = int(os.getenv("OCCURRENCE_CACHE_MAX_USERS", "2000"))
+OCCURRENCE_MAX_LIMIT = 100
 LAST_CHAT_AT: dict[str, datetime] = {}
 FIREBASE_APP = None
 FIRESTORE_DB = None
 
 
+class RequestTrace:
+    def __init__(self, sampled: bool):
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.spans: list[tuple[str, float, float]] = []
+
+
+_CURRENT_TRACE: contextvars.ContextVar[RequestTrace | None] = contextvars.ContextVar("current_trace", default=None)
+TRACE_LOG_LOCK = threading.Lock()
+
+
+def _record_span(name: str, started: float) -> None:
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        return
+    trace.spans.append((name, started - trace.started, time.perf_counter() - started))
+
+
+@contextmanager
+def _trace_span(name: str):
+    # Khi tracing tắt hoặc không có trace (thread ngoài request) thì chỉ tốn một lần đọc contextvar.
+    if _CURRENT_TRACE.get() is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_span(name, started)
+
+
+def _server_timing_header(trace: RequestTrace, total: float) -> str:
+    parts = [f"{name};dur={duration * 1000:.1f}" for name, _, duration in trace.spans]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def _write_trace_log(trace: RequestTrace, total: float, status_code: int) -> None:
+    line = json.dumps(
+        {
+            "ts": datetime.now(VN_TZ).isoformat(),
+            "method": request.method,
+            "path": request.path,
+            "status": status_code,
+            "total_ms": round(total * 1000, 1),
+            "spans": [
+                {"name": name, "start_ms": round(offset * 1000, 1), "dur_ms": round(duration * 1000, 1)}
+                for name, offset, duration in trace.spans
+            ],
+        },
+        ensure_ascii=False,
+    )
+    if not TRACE_LOG_PATH:
+        print(f"[Trace] {line}")
+        return
+    try:
+        with TRACE_LOG_LOCK, open(TRACE_LOG_PATH, "a", encoding="utf-8") as fh:
+            fh.write(line + "\n")
+    except OSError as exc:
+        print(f"[Trace] Ghi trace log lỗi: {exc}")
+
+
+@app.before_request
+def _start_request_trace():
+    if not TRACING_ENABLED:
+        return
+    trace = RequestTrace(sampled=random.random() < TRACE_SAMPLE_RATE)
+    g.trace = trace
+    g.trace_token = _CURRENT_TRACE.set(trace)
+
+
+@app.after_request
+def _finish_request_trace(response):
+    trace = g.get("trace")
+    if trace is None:
+        return response
+    total = time.perf_counter() - trace.started
+    response.headers["Server-Timing"] = _server_timing_header(trace, total)
+    if trace.sampled:
+        _write_trace_log(trace, total, response.status_code)
+    return response
+
+
+@app.teardown_request
+def _reset_request_trace(exc):
+    token = g.pop("trace_token", None)
+    if token is not None:
+        _CURRENT_TRACE.reset(token)
+
+
 def _get_firestore_client():
     global FIREBASE_APP, FIRESTORE_DB
     if firebase_admin is None:
@@ -147,31 +313,201 @@ class ExtractionError(Exception):
     pass
 
 
-def _prepare_image_for_vision(image_bytes: bytes, mime_type: str) -> tuple[bytes, str]:
-    max_size = 4 * 1024 * 1024
-    if len(image_bytes) <= max_size:
-        return image_bytes, mime_type or "image/jpeg"
-    return image_bytes[:max_size], mime_type or "image/jpeg"
+def _json_loads(text: str | bytes):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
 
 
-def _parse_vision_response(raw_text: str) -> dict:
+def _json_dumps(obj, *, sort_keys: bool = False) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys)
+
+
+class KairoJSONProvider(DefaultJSONProvider):
+    # jsonify/request.get_json đi qua orjson nếu có cài, không thì dùng provider mặc định của Flask.
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs) -> str:
+        # jsonify() luôn truyền separators compact (hoặc indent khi debug); orjson chỉ lo được trường hợp compact.
+        compact = not kwargs or kwargs == {"separators": (",", ":")}
+        if orjson is not None and compact:
+            try:
+                return orjson.dumps(obj).decode("utf-8")
+            except TypeError:
+                pass
+        kwargs.setdefault("ensure_ascii", False)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s: str | bytes, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+
+app.json = KairoJSONProvider(app)
+
+# Chỉ bỏ fence bọc ngoài JSON; fence nằm trong "reply" (ví dụ code mẫu) phải được giữ nguyên.
+_CODE_FENCE_RE = re.compile(r"\A\s*```[a-zA-Z]*|```\s*\Z")
+_SALVAGE_MAX_ATTEMPTS = 64
+# Object JSON thật luôn mở bằng `{"`; bỏ qua ngoặc nhọn trong văn xuôi, code hay tập hợp toán học ({1, 2}).
+_OBJECT_START_RE = re.compile(r'\{\s*"')
+_OBJECT_START_MAX_ATTEMPTS = 8
+# Backslash không phải escape JSON hợp lệ, thường gặp khi LLM viết LaTeX trong reply (\(x^2\)).
+_BACKSLASH_RE = re.compile(r'\\["\\/bfnrtu]?')
+
+
+def _salvage_truncated_json(text: str) -> dict | None:
+    """
+    Cứu JSON bị cắt cụt (LLM hết max_tokens): quét một lượt, ghi lại các điểm cắt an toàn
+    (sau khi đóng object/array, sau string ở cấp ngoài cùng, hoặc vừa mở array) cùng stack ngoặc
+    tại điểm đó, rồi thử từ điểm cắt muộn nhất: nối thêm các ngoặc đóng còn thiếu và parse lại.
+    """
+    stack: list[str] = []
+    cuts: list[tuple[int, str]] = []
+    in_string = False
+    escaped = False
+    for pos, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+                # Chỉ cắt sau string ở cấp ngoài cùng; bên trong mảng chỉ giữ các phần tử đã đóng đủ.
+                if len(stack) == 1:
+                    cuts.append((pos + 1, "".join(reversed(stack))))
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            # Không cắt ngay sau "{" ngoài cùng: object rỗng không cứu được gì, chỉ che lỗi parse.
+            if ch == "[":
+                cuts.append((pos + 1, "".join(reversed(stack))))
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            cuts.append((pos + 1, "".join(reversed(stack))))
+            if not stack:
+                break
+    else:
+        if in_string and len(stack) == 1:
+            # Bị cắt giữa chừng "reply": giữ phần chữ đã sinh ra thay vì bỏ hẳn.
+            cuts.append((len(text) - (1 if escaped else 0), '"' + "".join(reversed(stack))))
+
+    for cut, closers in reversed(cuts[-_SALVAGE_MAX_ATTEMPTS:]):
+        try:
+            parsed = json.loads(text[:cut] + closers)
+        except ValueError:
+            continue
+        if isinstance(parsed, dict):
+            return parsed
+    return None
+
+
+def _decode_complete_object(text: str, starts: list[int], expected_keys: tuple[str, ...]) -> dict | None:
+    # Đường nhanh: cả khối {...} là JSON hợp lệ.
+    end = text.rfind("}")
+    if end > starts[0]:
+        try:
+            parsed = _json_loads(text[starts[0] : end + 1])
+            if isinstance(parsed, dict) and any(key in parsed for key in expected_keys):
+                return parsed
+        except ValueError:
+            pass
+
+    # Có văn bản thừa chứa ngoặc trước/sau JSON: thử decode object bắt đầu ở từng vị trí `{"`.
+    decoder = json.JSONDecoder()
+    for start in starts:
+        try:
+            parsed, _ = decoder.raw_decode(text, start)
+        except ValueError:
+            continue
+        if isinstance(parsed, dict) and any(key in parsed for key in expected_keys):
+            return parsed
+    return None
+
+
+def _decode_llm_json(raw_text: str, expected_keys: tuple[str, ...] = ("reply", "subjects")) -> tuple[dict, bool]:
+    """
+    Parse JSON object từ output của LLM. Chịu được code fence, văn bản thừa trước/sau JSON,
+    escape LaTeX không hợp lệ và JSON bị cắt cụt. Object phải có ít nhất một key trong
+    expected_keys, nếu không coi như LLM không trả JSON. Trả về (object, truncated).
+    """
     if not raw_text:
         raise ExtractionError("Empty AI response")
-    start = raw_text.find("{")
-    end = raw_text.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        raise ExtractionError("Invalid JSON format from AI")
-    json_str = raw_text[start : end + 1]
-    try:
-        parsed = json.loads(json_str)
-    except json.JSONDecodeError as exc:
-        raise ExtractionError("Failed to parse AI JSON") from exc
-    if "subjects" not in parsed or not isinstance(parsed["subjects"], list):
+    text = _CODE_FENCE_RE.sub("", raw_text)
+    candidates = [text]
+    repaired = _BACKSLASH_RE.sub(lambda m: m.group(0) if len(m.group(0)) == 2 else "\\\\", text)
+    if repaired != text:
+        candidates.append(repaired)
+
+    starts_by_candidate = []
+    for candidate in candidates:
+        starts = [m.start() for m in _OBJECT_START_RE.finditer(candidate)][:_OBJECT_START_MAX_ATTEMPTS]
+        if not starts:
+            raise ExtractionError("Invalid JSON format from AI")
+        starts_by_candidate.append(starts)
+        parsed = _decode_complete_object(candidate, starts, expected_keys)
+        if parsed is not None:
+            return parsed, False
+
+    for candidate, starts in zip(candidates, starts_by_candidate):
+        for start in starts:
+            parsed = _salvage_truncated_json(candidate[start:])
+            if parsed is not None and any(key in parsed for key in expected_keys):
+                return parsed, True
+    raise ExtractionError("Failed to parse AI JSON")
+
+
+def _prepare_image_for_vision(image_bytes: bytes, mime_type: str) -> tuple[bytes | memoryview, str]:
+    if len(image_bytes) <= VISION_MAX_IMAGE_BYTES:
+        return image_bytes, mime_type or "image/jpeg"
+    # memoryview để cắt mà không copy thêm một bản ảnh nữa.
+    return memoryview(image_bytes)[:VISION_MAX_IMAGE_BYTES], mime_type or "image/jpeg"
+
+
+def _build_vision_request_body(prompt: str, image_bytes: bytes | memoryview, mime_type: str) -> bytes:
+    # Dựng body JSON đúng một lần cho mọi key: base64 chỉ gồm ký tự an toàn trong JSON
+    # nên ghép thẳng bytes vào giữa, tránh encode/escape lại cả ảnh ở mỗi lần retry.
+    placeholder = "__KAIRO_IMAGE_DATA__"
+    payload = {
+        "model": VISION_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:{mime_type};base64,{placeholder}"},
+                    },
+                ],
+            }
+        ],
+        "temperature": 0.7,
+        "max_tokens": 1000,
+        "response_format": {"type": "json_object"},
+    }
+    prefix, suffix = json.dumps(payload).encode("utf-8").rsplit(placeholder.encode("ascii"), 1)
+    return b"".join((prefix, base64.b64encode(image_bytes), suffix))
+
+
+def _parse_vision_response(raw_text: str) -> dict:
+    parsed, _ = _decode_llm_json(raw_text, ("subjects", "image_summary"))
+    if not isinstance(parsed.get("subjects"), list):
         parsed["subjects"] = []
     return parsed
 
 
-def _call_ai_with_image(image_bytes: bytes, mime_type: str) -> dict:
+def _call_ai_with_image(image_bytes: bytes, mime_type: str, deadline: float | None = None) -> dict:
     image_bytes, mime_type = _prepare_image_for_vision(image_bytes, mime_type)
 
     raw = get_ai_response(
@@ -179,11 +515,15 @@ def _call_ai_with_image(image_bytes: bytes, mime_type: str) -> dict:
         vision_prompt=EXTRACTION_PROMPT,
         image_bytes=image_bytes,
         mime_type=mime_type,
+        deadline=deadline,
     )
 
     if raw:
         try:
-            return _parse_vision_response(raw)
+            with _trace_span("parse"):
+                parsed = _parse_vision_response(raw)
+            parsed["subjects"] = _normalize_subjects(parsed["subjects"])
+            return parsed
         except ExtractionError as exc:
             print(f"AI Vision trả về JSON lỗi: {exc}")
 
@@ -194,25 +534,233 @@ def _call_ai_with_image(image_bytes: bytes, mime_type: str) -> dict:
 
 
 def _parse_ai_response(raw_text: str) -> dict:
-    if not raw_text:
-        raise ExtractionError("Empty AI response")
-    start = raw_text.find("{")
-    end = raw_text.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        raise ExtractionError("Invalid JSON format from AI")
-    json_str = raw_text[start : end + 1]
-    try:
-        parsed = json.loads(json_str)
-    except json.JSONDecodeError as exc:
-        raise ExtractionError("Failed to parse AI JSON") from exc
-    if "reply" not in parsed or not isinstance(parsed.get("reply"), str):
+    parsed, truncated = _decode_llm_json(raw_text)
+    if not isinstance(parsed.get("reply"), str) or not parsed["reply"].strip():
         parsed["reply"] = "KairoAI đã nhận được yêu cầu của đại ca."
-    if "subjects" not in parsed or not isinstance(parsed["subjects"], list):
-        parsed["subjects"] = []
+    # Mảng subjects bị cắt cụt chỉ là một phần lịch: không dùng để ghi đè lịch hiện tại.
+    if truncated or not isinstance(parsed.get("subjects"), list):
+        parsed["subjects"] = None
     return parsed
 
 
-def _call_groq_chat_once(api_key: str, system_prompt: str, user_prompt: str) -> tuple[str | None, bool]:
+class CircuitBreaker:
+    """
+    Circuit breaker cho một provider/endpoint.
+    closed -> open sau N lỗi liên tiếp; open -> half_open sau thời gian hồi phục,
+    khi đó chỉ cho đúng một request thăm dò đi qua để quyết định đóng lại hay mở tiếp.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, recovery_seconds: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_seconds = recovery_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.recovery_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                print(f"[Circuit] {self.name} hoạt động lại, chuyển về CLOSED.")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"[Circuit] {self.name} lỗi {self.failures} lần, chuyển sang OPEN.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == self.OPEN
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "failures": self.failures}
+
+
+GROQ_CHAT_BREAKER = CircuitBreaker("groq_chat", BREAKER_FAILURE_THRESHOLD, BREAKER_RECOVERY_SECONDS)
+GROQ_VISION_BREAKER = CircuitBreaker("groq_vision", BREAKER_FAILURE_THRESHOLD, BREAKER_RECOVERY_SECONDS)
+DEEPSEEK_BREAKER = CircuitBreaker("deepseek_chat", BREAKER_FAILURE_THRESHOLD, BREAKER_RECOVERY_SECONDS)
+
+
+def _new_deadline() -> float:
+    return time.monotonic() + REQUEST_DEADLINE_SECONDS
+
+
+def _remaining_timeout(deadline: float | None) -> float | None:
+    # Timeout cho một lần gọi upstream, co lại dần theo deadline của cả request.
+    if deadline is None:
+        return UPSTREAM_TIMEOUT_SECONDS
+    remaining = deadline - time.monotonic()
+    if remaining < MIN_UPSTREAM_TIMEOUT_SECONDS:
+        return None
+    return min(UPSTREAM_TIMEOUT_SECONDS, remaining)
+
+
+def _is_provider_failure(exc: Exception) -> bool:
+    # 429 / 4xx nghĩa là provider vẫn sống (chỉ là key bị giới hạn hoặc sai), không tính là lỗi cho breaker.
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        return exc.response.status_code >= 500
+    return True
+
+
+class UsageLedger:
+    """
+    Đếm token/request theo cửa sổ trượt cho từng chiều (user, key, model).
+    Mỗi chuỗi số liệu chia thành bucket cố định; tổng của cửa sổ = tổng các bucket còn trong span.
+    Số liệu chỉ nằm trong bộ nhớ process: backend bắt buộc chạy một process (gunicorn.conf.py từ chối
+    khởi động khi workers != 1), nên quota và /admin/usage phản ánh toàn bộ traffic; restart thì đếm lại từ đầu.
+    """
+
+    WINDOWS = {"minute": (10, 60), "day": (3600, 86400)}
+    SWEEP_INTERVAL_SECONDS = 60
+
+    def __init__(self):
+        self._series: dict[tuple[str, str, str], dict[int, list[int]]] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def _prune(self, series: dict[int, list[int]], window: str, now: float) -> None:
+        _, span = self.WINDOWS[window]
+        for bucket in [b for b in series if b <= now - span]:
+            del series[bucket]
+
+    def _sweep(self, now: float) -> None:
+        # Bỏ chuỗi số liệu đã hết hạn của các user không quay lại; gọi khi đang giữ lock.
+        for key in list(self._series):
+            series = self._series[key]
+            self._prune(series, key[2], now)
+            if not series:
+                del self._series[key]
+        self._last_sweep = now
+
+    def record(self, dimensions: list[tuple[str, str]], prompt_tokens: int, completion_tokens: int) -> None:
+        now = time.time()
+        with self._lock:
+            if now - self._last_sweep >= self.SWEEP_INTERVAL_SECONDS:
+                self._sweep(now)
+            for dimension, ident in dimensions:
+                for window, (bucket_seconds, _) in self.WINDOWS.items():
+                    series = self._series.setdefault((dimension, ident, window), {})
+                    self._prune(series, window, now)
+                    bucket = series.setdefault(int(now // bucket_seconds * bucket_seconds), [0, 0, 0])
+                    bucket[0] += prompt_tokens
+                    bucket[1] += completion_tokens
+                    bucket[2] += 1
+
+    def totals(self, dimension: str, ident: str, window: str) -> dict:
+        now = time.time()
+        prompt = completion = requests_count = 0
+        with self._lock:
+            series = self._series.get((dimension, ident, window))
+            if series is not None:
+                self._prune(series, window, now)
+                for p, c, r in series.values():
+                    prompt += p
+                    completion += c
+                    requests_count += r
+                if not series:
+                    del self._series[(dimension, ident, window)]
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+            "requests": requests_count,
+        }
+
+    def idents(self, dimension: str) -> list[str]:
+        with self._lock:
+            self._sweep(time.time())
+            return sorted({ident for dim, ident, _ in self._series if dim == dimension})
+
+
+USAGE_LEDGER = UsageLedger()
+_CURRENT_USER: contextvars.ContextVar[str | None] = contextvars.ContextVar("current_user", default=None)
+
+
+def _key_label(api_key: str | None) -> str:
+    # Không bao giờ đưa key thật ra log/endpoint, chỉ dùng nhãn.
+    for label, key in (("groq_1", GROQ_KEY_1), ("groq_2", GROQ_KEY_2), ("groq_3", GROQ_KEY_3), ("groq_4", GROQ_KEY_4)):
+        if key and api_key == key:
+            return label
+    if DEEPSEEK_API_KEY and api_key == DEEPSEEK_API_KEY:
+        return "deepseek"
+    return "unknown"
+
+
+def _record_usage(api_key: str, model: str, data: dict) -> None:
+    usage = data.get("usage") or {}
+    try:
+        prompt_tokens = int(usage.get("prompt_tokens") or 0)
+        completion_tokens = int(usage.get("completion_tokens") or 0)
+    except (TypeError, ValueError):
+        prompt_tokens = completion_tokens = 0
+    dimensions = [("key", _key_label(api_key)), ("model", model)]
+    user_id = _CURRENT_USER.get()
+    if user_id:
+        dimensions.append(("user", user_id))
+    USAGE_LEDGER.record(dimensions, prompt_tokens, completion_tokens)
+
+
+def _key_pressure(label: str) -> float:
+    minute = USAGE_LEDGER.totals("key", label, "minute")
+    day = USAGE_LEDGER.totals("key", label, "day")
+    return max(minute["total_tokens"] / max(1, KEY_TOKENS_PER_MINUTE), day["requests"] / max(1, KEY_REQUESTS_PER_DAY))
+
+
+def _key_exhausted(api_key: str) -> bool:
+    return _key_pressure(_key_label(api_key)) >= 1.0
+
+
+def _usage_policy(user_id: str) -> str:
+    # "block" = hết quota ngày; "short" = ép trả lời ngắn; "ok" = bình thường.
+    used = USAGE_LEDGER.totals("user", user_id, "day")["total_tokens"]
+    if used >= USER_DAILY_TOKEN_LIMIT:
+        return "block"
+    if used >= USER_DAILY_TOKEN_SOFT_LIMIT:
+        return "short"
+    labels = [_key_label(k) for k in (GROQ_KEY_1, GROQ_KEY_2, GROQ_KEY_3) if k]
+    if labels and min(_key_pressure(label) for label in labels) >= KEY_PRESSURE_THRESHOLD:
+        # Key dùng chung sắp chạm giới hạn: hạ cấp user nặng trước để mọi người không cùng rơi vào FALLBACK_MESSAGE.
+        if used >= USER_DAILY_TOKEN_SOFT_LIMIT // 2:
+            return "short"
+    return "ok"
+
+
+def _call_groq_chat_once(
+    api_key: str,
+    system_prompt: str,
+    user_prompt: str,
+    timeout: float = UPSTREAM_TIMEOUT_SECONDS,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+) -> tuple[str | None, bool]:
     if not api_key:
         return None, False
     try:
@@ -228,11 +776,13 @@ def _call_groq_chat_once(api_key: str, system_prompt: str, user_prompt: str) ->
                 {"role": "user", "content": user_prompt},
             ],
             "temperature": 0.7,
-            "max_tokens": 1000,
+            "max_tokens": max_tokens,
         }
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
+        resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
         resp.raise_for_status()
         data = resp.json()
+        GROQ_CHAT_BREAKER.record_success()
+        _record_usage(api_key, CHAT_MODEL, data)
         choices = data.get("choices") or []
         if not choices:
             print("Groq chat trả về rỗng hoặc không có choices.")
@@ -245,45 +795,29 @@ def _call_groq_chat_once(api_key: str, system_prompt: str, user_prompt: str) ->
     except Exception as exc:
         msg = str(exc).lower()
         is_rate_limit = "429" in msg or "rate limit" in msg
+        if _is_provider_failure(exc):
+            GROQ_CHAT_BREAKER.record_failure()
+        else:
+            GROQ_CHAT_BREAKER.record_success()
         print(f"Groq chat lỗi với một key: {exc}")
         return None, is_rate_limit
 
 
-def _call_groq_vision_once(api_key: str, prompt: str, image_bytes: bytes, mime_type: str) -> tuple[str | None, bool]:
+def _call_groq_vision_once(api_key: str, body: bytes, timeout: float = UPSTREAM_TIMEOUT_SECONDS) -> tuple[str | None, bool]:
     if not api_key:
         return None, False
 
-    encoded_image = base64.b64encode(image_bytes).decode("utf-8")
-
     try:
         url = "https://api.groq.com/openai/v1/chat/completions"
         headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json",
         }
-        payload = {
-            "model": VISION_MODEL,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{encoded_image}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            "temperature": 0.7,
-            "max_tokens": 1000,
-            "response_format": {"type": "json_object"},
-        }
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
+        resp = requests.post(url, headers=headers, data=body, timeout=timeout)
         resp.raise_for_status()
         data = resp.json()
+        GROQ_VISION_BREAKER.record_success()
+        _record_usage(api_key, VISION_MODEL, data)
         choices = data.get("choices") or []
         if not choices:
             print("Groq Vision trả về rỗng hoặc không có choices.")
@@ -296,11 +830,20 @@ def _call_groq_vision_once(api_key: str, prompt: str, image_bytes: bytes, mime_t
     except Exception as exc:
         msg = str(exc).lower()
         is_rate_limit = "429" in msg or "rate limit" in msg
+        if _is_provider_failure(exc):
+            GROQ_VISION_BREAKER.record_failure()
+        else:
+            GROQ_VISION_BREAKER.record_success()
         print(f"Groq Vision lỗi với một key: {exc}")
         return None, is_rate_limit
 
 
-def _call_deepseek_chat(system_prompt: str, user_prompt: str) -> str | None:
+def _call_deepseek_chat(
+    system_prompt: str,
+    user_prompt: str,
+    timeout: float = UPSTREAM_TIMEOUT_SECONDS,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+) -> str | None:
     api_key = DEEPSEEK_API_KEY
     if not api_key:
         return None
@@ -316,14 +859,16 @@ def _call_deepseek_chat(system_prompt: str, user_prompt: str) -> str | None:
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
         ],
-        "max_tokens": 1000,
+        "max_tokens": max_tokens,
         "temperature": 0.7,
     }
 
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
+        resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
         resp.raise_for_status()
         data = resp.json()
+        DEEPSEEK_BREAKER.record_success()
+        _record_usage(api_key, "deepseek-chat", data)
         choices = data.get("choices") or []
         if not choices:
             print("DeepSeek trả về rỗng hoặc không có choices.")
@@ -334,6 +879,10 @@ def _call_deepseek_chat(system_prompt: str, user_prompt: str) -> str | None:
             text = str(text)
         return text
     except Exception as exc:
+        if _is_provider_failure(exc):
+            DEEPSEEK_BREAKER.record_failure()
+        else:
+            DEEPSEEK_BREAKER.record_success()
         print(f"DeepSeek cũng lỗi luôn: {exc}")
         return None
 
@@ -344,25 +893,52 @@ def get_ai_response(
     system_prompt: str | None = None,
     user_prompt: str | None = None,
     vision_prompt: str | None = None,
-    image_bytes: bytes | None = None,
+    image_bytes: bytes | memoryview | None = None,
     mime_type: str | None = None,
+    deadline: float | None = None,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
 ) -> str | None:
+    if deadline is None:
+        deadline = _new_deadline()
+
     if mode == "text":
         keys = [k for k in (GROQ_KEY_1, GROQ_KEY_2, GROQ_KEY_3) if k]
         any_key = bool(keys)
         all_429 = bool(keys)
-
-        for api_key in keys:
-            raw, is_429 = _call_groq_chat_once(api_key, system_prompt or "", user_prompt or "")
+        groq_unavailable = False
+
+        for index, api_key in enumerate(keys, start=1):
+            timeout = _remaining_timeout(deadline)
+            if timeout is None:
+                print("[Deadline] Hết thời gian cho request chat, trả về fallback.")
+                return FALLBACK_MESSAGE
+            if _key_exhausted(api_key):
+                # Theo ledger key này đã chạm TPM/RPD: coi như 429, sang key kế tiếp ngay.
+                continue
+            if not GROQ_CHAT_BREAKER.allow_request():
+                groq_unavailable = True
+                break
+            with _trace_span(f"groq_chat_k{index}"):
+                raw, is_429 = _call_groq_chat_once(
+                    api_key, system_prompt or "", user_prompt or "", timeout=timeout, max_tokens=max_tokens
+                )
             if raw:
                 return raw
             if not is_429:
                 all_429 = False
 
-        if all_429 and any_key:
-            raw = _call_deepseek_chat(system_prompt or "", user_prompt or "")
-            if raw:
-                return raw
+        if GROQ_CHAT_BREAKER.is_open():
+            groq_unavailable = True
+
+        if (all_429 or groq_unavailable) and any_key:
+            timeout = _remaining_timeout(deadline)
+            if timeout is not None and DEEPSEEK_BREAKER.allow_request():
+                with _trace_span("deepseek_chat"):
+                    raw = _call_deepseek_chat(
+                        system_prompt or "", user_prompt or "", timeout=timeout, max_tokens=max_tokens
+                    )
+                if raw:
+                    return raw
 
         return FALLBACK_MESSAGE
 
@@ -370,63 +946,37 @@ def get_ai_response(
         keys = [k for k in (GROQ_KEY_1, GROQ_KEY_2, GROQ_KEY_3) if k]
         any_key = bool(keys)
         all_429 = bool(keys)
-
-        for api_key in keys:
-            raw, is_429 = _call_groq_vision_once(
-                api_key,
-                vision_prompt or "",
-                image_bytes or b"",
-                mime_type or "image/jpeg",
-            )
+        body = _build_vision_request_body(vision_prompt or "", image_bytes or b"", mime_type or "image/jpeg")
+
+        for index, api_key in enumerate(keys, start=1):
+            timeout = _remaining_timeout(deadline)
+            if timeout is None:
+                return FALLBACK_MESSAGE
+            if _key_exhausted(api_key):
+                continue
+            if not GROQ_VISION_BREAKER.allow_request():
+                # GROQ_KEY_4 cũng đi qua cùng endpoint Groq, breaker mở thì fail fast luôn.
+                return FALLBACK_MESSAGE
+            with _trace_span(f"groq_vision_k{index}"):
+                raw, is_429 = _call_groq_vision_once(api_key, body, timeout=timeout)
             if raw:
                 return raw
             if not is_429:
                 all_429 = False
 
         if all_429 and any_key and GROQ_KEY_4:
-            raw, _ = _call_groq_vision_once(
-                GROQ_KEY_4,
-                vision_prompt or "",
-                image_bytes or b"",
-                mime_type or "image/jpeg",
-            )
-            if raw:
-                return raw
+            timeout = _remaining_timeout(deadline)
+            if timeout is not None and GROQ_VISION_BREAKER.allow_request():
+                with _trace_span("groq_vision_k4"):
+                    raw, _ = _call_groq_vision_once(GROQ_KEY_4, body, timeout=timeout)
+                if raw:
+                    return raw
 
         return FALLBACK_MESSAGE
 
     return FALLBACK_MESSAGE
 
 
-def _build_persona_intro(persona: str) -> str:
-    if persona == "funny":
-        style = (
-            "Mày là một chuyên gia giải toán nhưng có tâm hồn của một TikToker triệu view. "
-            "Cách nói chuyện phải dùng nhiều tiếng lóng của giới trẻ, hay dùng các câu joke kiểu vô tri "
-            "hoặc thả thính lắt léo. Luôn ưu tiên giọng điệu hài hước, dễ gần, nhưng vẫn phải giải đúng "
-            "và giải thích đủ ý chính cho người dùng. Phong cách: thường xuyên dùng icon kiểu 💀, 😂, 🤡, ☕ "
-            "ở những chỗ hợp lý."
-        )
-    elif persona == "angry":
-        style = (
-            "Mày đang trong trạng thái cực kỳ khó ở vì phải đi giải bài tập hộ người khác. "
-            "Tuyệt đối xưng Tao - Mày cho nó máu lửa. Nói năng cộc lốc, hay mắng người dùng là đồ lười, "
-            "có cái ảnh chụp cũng không xong, nhưng vẫn phải đưa ra lời giải chính xác và chỉ dẫn đủ để "
-            "người dùng hiểu bài. Không được dùng các từ xúc phạm nặng về tôn giáo, sắc tộc, giới tính. "
-            "Phong cách: hay chèn icon 💢, 🙄, 👊 ở cuối câu cho đúng vibe."
-        )
-    else:
-        style = (
-            "Mày là một trợ lý AI chuẩn mực, chuyên nghiệp và điềm đạm. "
-            "Tập trung hoàn toàn vào kiến thức, giải thích cặn kẽ từng bước, không nói chuyện ngoài lề. "
-            "Quy tắc: xưng Tôi - Bạn hoặc KairoAI - Bạn. Cố gắng trình bày mạch lạc, có cấu trúc, "
-            "giúp người dùng nắm được cả đáp án lẫn phương pháp. Phong cách: hầu như không dùng icon, "
-            "nếu cần thì chỉ dùng 📝 hoặc ✅."
-        )
-
-    return style
-
-
 def _build_full_week_subjects_from_message(message: str) -> list[dict]:
     text = (message or "").strip()
     lower = text.lower()
@@ -551,16 +1101,27 @@ def _format_target_time_hint(target: datetime, duration_str: str) -> str:
     day_str = days_map.get(target.weekday(), "")
     time_str = target.strftime("%H:%M")
     date_str = target.strftime("%d/%m/%Y")
+    iso_date_str = target.strftime("%Y-%m-%d")
     return (
         f"HỆ THỐNG ĐÃ TÍNH TOÁN CHÍNH XÁC: Người dùng muốn nhắc sau {duration_str}. "
         f"Thời gian mục tiêu là: {day_str}, {time_str} (ngày {date_str}). "
-        f"Hãy tạo subject với day_of_week='{day_str}', start_time='{time_str}', specific_date='{date_str}'."
+        f"Hãy tạo subject với day_of_week='{day_str}', start_time='{time_str}', specific_date='{iso_date_str}'."
     )
 
 
 def _call_ai_for_chat(
-    persona: str, history: list, message: str, subjects: list, time_mode: str, current_time_str: str
+    persona: str,
+    history: list,
+    message: str,
+    subjects: list,
+    time_mode: str,
+    current_time_str: str,
+    deadline: float | None = None,
+    user_id: str | None = None,
+    short_reply: bool = False,
+    cache_key: str | None = None,
 ) -> dict:
+    prompt_started = time.perf_counter()
     persona_intro = _build_persona_intro(persona)
     
     # Tính toán relative time hint
@@ -574,6 +1135,11 @@ def _call_ai_for_chat(
         if time_mode == "night"
         else ""
     )
+    if short_reply and not short_mode_note:
+        short_mode_note = (
+            "\nTài khoản này đang dùng nhiều tài nguyên. "
+            "Bạn phải trả lời thật ngắn gọn, ưu tiên 2-4 câu hoặc vài gạch đầu dòng."
+        )
 
     system_prompt = f"""
 Bạn là KairoAI, trợ lý AI đa năng và là đàn em trung thành nhất của người dùng.
@@ -635,10 +1201,6 @@ Quản lý thời gian biểu trong app:
   + Tìm trong danh sách subjects công việc có name khớp với [Tên việc] (ưu tiên so khớp gần đúng, không phân biệt hoa thường).
   + Nếu tìm được, lấy mốc thời gian hiện tại của công việc đó, cộng thêm X phút để ra giờ mới, và cập nhật lại start_time (và specific_date nếu cần) sao cho phản ánh đúng giờ mới.
   + Trong câu trả lời ("reply"), phải nói rõ là đã dời lịch [Tên việc] sang giờ mới nào.
-- Khi thêm lịch mới hoặc dời lịch, phải kiểm tra trùng lặp với các subject hiện có:
-  + Nếu mốc giờ mới trùng hoặc nằm trong khoảng +/- 5 phút so với một subject khác cùng ngày, hãy thêm cảnh báo trong "reply"
-    (ví dụ: "Lưu ý: mốc giờ này đang gần trùng với lịch [Tên khác] lúc HH:MM").
-  + Tuy nhiên vẫn nên tạo hoặc cập nhật subject, trừ khi người dùng yêu cầu hủy.
 - Với các yêu cầu sắp lịch lặp lại nhiều ngày trong tuần ("mỗi ngày", "hàng ngày", "cả tuần", "full tuần", "nguyên tuần", "từ thứ 2 đến chủ nhật", v.v.):
   + Tuyệt đối không được gom tất cả vào một subject duy nhất.
   + Phải tạo NHIỀU subject riêng biệt, mỗi subject tương ứng với MỘT ngày trong tuần.
@@ -701,29 +1263,66 @@ Yêu cầu về câu trả lời gửi cho người dùng:
         prefix = "Người dùng:" if role == "user" else "KairoAI:"
         history_text += f"{prefix} {content}\n"
 
-    subjects_text = json.dumps(subjects, ensure_ascii=False)
+    query_days = _schedule_query_days(message, now_vn_calc.date())
+    raw_reply = None
+    # Câu hỏi xem lịch thử trước với khối lịch tính sẵn thay cho mảng subjects; nếu LLM vẫn muốn sửa lịch thì hỏi lại đủ dữ liệu.
+    # Câu còn lại chỉ gửi subjects như cũ, không kèm khối tính sẵn để khỏi tốn thêm token.
+    for query_only in (True, False) if query_days else (False,):
+        if query_only:
+            occurrences = _get_user_occurrences(user_id or "anonymous", _normalize_subjects(subjects), now_vn_calc.date())
+            upcoming_block = _build_upcoming_block(occurrences, now_vn_calc, query_days)
+            schedule_text = (
+                f"Lịch đã tính sẵn theo giờ Việt Nam:\n{upcoming_block}\n"
+                "(Đây là câu hỏi xem lịch nên không gửi kèm mảng subjects; hãy bỏ trường \"subjects\" trong JSON trả về, "
+                "hệ thống sẽ giữ nguyên lịch.)\n\n"
+            )
+        else:
+            subjects_text = json.dumps(subjects, ensure_ascii=False)
+            schedule_text = f"Lịch hiện tại (subjects): {subjects_text}\n\n"
+
+        user_prompt = (
+            f"Thời gian hiện tại: {current_time_str}\n"
+            f"{relative_time_hint}\n"
+            f"Chế độ thời gian: {'ban ngày (7h-23h)' if time_mode == 'day' else 'ban đêm (23h-7h, trả lời ngắn gọn)'}.\n"
+            f"{schedule_text}"
+            f"Lịch sử hội thoại:\n{history_text}\n"
+            f"Tin nhắn mới của người dùng: {message}\n\n"
+            "Hãy trả lời theo đúng định dạng JSON đã quy định ở trên."
+        )
 
-    user_prompt = (
-        f"Thời gian hiện tại: {current_time_str}\n"
-        f"{relative_time_hint}\n"
-        f"Chế độ thời gian: {'ban ngày (7h-23h)' if time_mode == 'day' else 'ban đêm (23h-7h, trả lời ngắn gọn)'}.\n"
-        f"Lịch hiện tại (subjects): {subjects_text}\n\n"
-        f"Lịch sử hội thoại:\n{history_text}\n"
-        f"Tin nhắn mới của người dùng: {message}\n\n"
-        "Hãy trả lời theo đúng định dạng JSON đã quy định ở trên."
-    )
+        _record_span("prompt_build", prompt_started)
 
-    raw_reply = get_ai_response(
-        "text",
-        system_prompt=system_prompt,
-        user_prompt=user_prompt,
-    )
+        raw_reply = get_ai_response(
+            "text",
+            system_prompt=system_prompt,
+            user_prompt=user_prompt,
+            deadline=deadline,
+            max_tokens=SHORT_REPLY_MAX_TOKENS if short_reply else DEFAULT_MAX_TOKENS,
+        )
+        if not raw_reply:
+            break
 
-    if raw_reply:
         try:
-            return _parse_ai_response(raw_reply)
+            with _trace_span("parse"):
+                parsed = _parse_ai_response(raw_reply)
         except ExtractionError as exc:
             print(f"AI chat trả về JSON lỗi: {exc}")
+            break
+        if query_only:
+            if parsed["subjects"]:
+                # LLM không thấy subjects mà vẫn trả lịch: coi như câu sửa lịch, gọi lại với đầy đủ subjects.
+                prompt_started = time.perf_counter()
+                continue
+            parsed["subjects"] = subjects
+        elif (
+            cache_key
+            and parsed["reply"] != FALLBACK_MESSAGE
+            and isinstance(parsed["subjects"], list)
+            and _normalize_subjects(parsed["subjects"]) == _normalize_subjects(subjects)
+        ):
+            # Chỉ lưu khi LLM xác nhận lịch không đổi, tức câu trả lời thật sự không phụ thuộc lịch.
+            CHAT_RESPONSE_CACHE.set(cache_key, parsed["reply"])
+        return parsed
 
     local_subjects = _build_full_week_subjects_from_message(message)
     if local_subjects:
@@ -741,35 +1340,400 @@ Yêu cầu về câu trả lời gửi cho người dùng:
     }
 
 
-def _parse_ai_response(raw_json: str) -> dict:
+class AdmissionController:
+    """
+    Giới hạn số lời gọi LLM đang chạy: toàn cục, theo từng lớp (chat/vision) và theo từng user.
+    Lớp có priority nhỏ hơn được ưu tiên: khi còn request lớp cao hơn đang chờ, lớp thấp không được chen slot.
+    Bộ đếm nằm trong process: chỉ có tác dụng vì gunicorn.conf.py chạy một process nhiều thread,
+    với số thread lớn hơn LLM_MAX_INFLIGHT để request vượt giới hạn vẫn có thread nhận và từ chối.
+    """
+
+    def __init__(self, max_inflight: int, per_user: int, class_limits: dict[str, int], priorities: dict[str, int]):
+        self.max_inflight = max(1, max_inflight)
+        self.per_user = max(1, per_user)
+        self.class_limits = class_limits
+        self.priorities = priorities
+        self.inflight = 0
+        self.class_inflight = {name: 0 for name in class_limits}
+        self.waiting = {name: 0 for name in class_limits}
+        self.user_inflight: dict[str, int] = {}
+        self._cond = threading.Condition()
+
+    def _can_admit(self, klass: str, user_id: str) -> bool:
+        if self.inflight >= self.max_inflight:
+            return False
+        if self.class_inflight[klass] >= self.class_limits[klass]:
+            return False
+        if self.user_inflight.get(user_id, 0) >= self.per_user:
+            return False
+        rank = self.priorities[klass]
+        return not any(count and self.priorities[other] < rank for other, count in self.waiting.items())
+
+    def acquire(self, klass: str, user_id: str, timeout: float) -> str | None:
+        # None = được nhận; "user_limit" / "busy" = bị từ chối.
+        end = time.monotonic() + max(0.0, timeout)
+        with self._cond:
+            if self.user_inflight.get(user_id, 0) >= self.per_user:
+                return "user_limit"
+            self.waiting[klass] += 1
+            try:
+                while not self._can_admit(klass, user_id):
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        return "busy"
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting[klass] -= 1
+                self._cond.notify_all()
+            self.inflight += 1
+            self.class_inflight[klass] += 1
+            self.user_inflight[user_id] = self.user_inflight.get(user_id, 0) + 1
+            return None
+
+    def release(self, klass: str, user_id: str) -> None:
+        with self._cond:
+            self.inflight -= 1
+            self.class_inflight[klass] -= 1
+            count = self.user_inflight.get(user_id, 0) - 1
+            if count > 0:
+                self.user_inflight[user_id] = count
+            else:
+                self.user_inflight.pop(user_id, None)
+            self._cond.notify_all()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "inflight": self.inflight,
+                "by_class": dict(self.class_inflight),
+                "waiting": dict(self.waiting),
+                "users": len(self.user_inflight),
+            }
+
+
+LLM_ADMISSION = AdmissionController(
+    LLM_MAX_INFLIGHT,
+    LLM_MAX_INFLIGHT_PER_USER,
+    class_limits={"chat": LLM_MAX_INFLIGHT, "vision": min(VISION_MAX_INFLIGHT, LLM_MAX_INFLIGHT)},
+    priorities={"chat": 0, "vision": 1},
+)
+
+
+def _admission_rejected_response(reason: str):
+    if reason == "user_limit":
+        return (
+            jsonify(
+                {
+                    "error": "too_many_requests",
+                    "message": "Bạn đang có yêu cầu khác chưa xử lý xong, đợi một chút rồi gửi tiếp nhé.",
+                }
+            ),
+            429,
+            {"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)},
+        )
+    return (
+        jsonify({"error": "busy", "message": FALLBACK_MESSAGE}),
+        503,
+        {"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)},
+    )
+
+
+EXTRACT_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, EXTRACT_WORKERS), thread_name_prefix="extract")
+EXTRACT_JOBS: dict[str, dict] = {}
+EXTRACT_JOBS_LOCK = threading.Lock()
+EXTRACT_PENDING = 0
+
+
+def _purge_expired_jobs(now: float) -> None:
+    expired = [
+        job_id
+        for job_id, job in EXTRACT_JOBS.items()
+        if job["finished_at"] is not None and now - job["finished_at"] > EXTRACT_JOB_TTL_SECONDS
+    ]
+    for job_id in expired:
+        del EXTRACT_JOBS[job_id]
+
+
+def _run_extraction_job(job: dict, image_bytes: bytes, mime_type: str, deadline: float | None) -> None:
+    global EXTRACT_PENDING
+    job["status"] = "running"
+    if deadline is None:
+        deadline = _new_deadline()
     try:
-        # Clean up code blocks if present
-        clean_json = raw_json.strip()
-        if clean_json.startswith("```"):
-            lines = clean_json.splitlines()
-            if lines[0].startswith("```"):
-                lines = lines[1:]
-            if lines and lines[-1].startswith("```"):
-                lines = lines[:-1]
-            clean_json = "\n".join(lines).strip()
-        
-        data = json.loads(clean_json)
-        return data
-    except json.JSONDecodeError as e:
-        raise ExtractionError(f"Invalid JSON: {e}")
+        # Vision có priority thấp hơn chat nên được phép chờ slot tới hết deadline của job.
+        with _trace_span("admission"):
+            rejected = LLM_ADMISSION.acquire("vision", job["user_id"], deadline - time.monotonic())
+        if rejected:
+            job["error"] = "busy"
+            job["status"] = "failed"
+            return
+        _CURRENT_USER.set(job["user_id"])
+        try:
+            job["result"] = _call_ai_with_image(image_bytes, mime_type, deadline=deadline)
+            job["status"] = "done"
+        finally:
+            LLM_ADMISSION.release("vision", job["user_id"])
+    except Exception as exc:
+        print(f"[Extract] Job {job['id']} lỗi: {exc}")
+        job["error"] = str(exc)
+        job["status"] = "failed"
+    finally:
+        with EXTRACT_JOBS_LOCK:
+            EXTRACT_PENDING -= 1
+            job["finished_at"] = time.monotonic()
+        job["done"].set()
+
+
+def _submit_extraction_job(
+    image_bytes: bytes, mime_type: str, user_id: str, deadline: float | None = None
+) -> tuple[dict | None, str | None]:
+    # Từ chối ngay khi hàng đợi đầy ("busy") hoặc user đã có quá nhiều job ("user_limit"), không giữ worker.
+    global EXTRACT_PENDING
+    with EXTRACT_JOBS_LOCK:
+        _purge_expired_jobs(time.monotonic())
+        if EXTRACT_PENDING >= max(1, EXTRACT_WORKERS) + EXTRACT_QUEUE_MAX:
+            return None, "busy"
+        user_pending = sum(
+            1 for job in EXTRACT_JOBS.values() if job["user_id"] == user_id and job["finished_at"] is None
+        )
+        if user_pending >= EXTRACT_MAX_JOBS_PER_USER:
+            return None, "user_limit"
+        EXTRACT_PENDING += 1
+        job = {
+            "id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "status": "queued",
+            "result": None,
+            "error": None,
+            "finished_at": None,
+            "done": threading.Event(),
+        }
+        EXTRACT_JOBS[job["id"]] = job
+    # Copy context để span của job (chế độ đồng bộ) vẫn ghi vào trace của request.
+    EXTRACT_EXECUTOR.submit(contextvars.copy_context().run, _run_extraction_job, job, image_bytes, mime_type, deadline)
+    return job, None
 
 
-class ExtractionError(Exception):
-    pass
+def _extraction_job_payload(job: dict) -> dict:
+    payload = {"job_id": job["id"], "status": job["status"]}
+    if job["status"] == "done":
+        payload["result"] = job["result"]
+    elif job["status"] == "failed":
+        payload["error"] = job["error"]
+    return payload
+
+
+def _extraction_busy_response():
+    return (
+        jsonify(
+            {
+                "error": "busy",
+                "message": "Hệ thống đang xử lý quá nhiều ảnh, bạn thử lại sau vài giây nhé.",
+            }
+        ),
+        503,
+        {"Retry-After": str(EXTRACT_RETRY_AFTER_SECONDS)},
+    )
+
+
+def _upload_too_large_response():
+    limit_mb = VISION_MAX_IMAGE_BYTES / (1024 * 1024)
+    return (
+        jsonify(
+            {
+                "error": "file_too_large",
+                "message": f"Ảnh quá lớn, bạn gửi ảnh dưới {limit_mb:.0f}MB giúp mình nhé.",
+            }
+        ),
+        413,
+    )
+
+
+@app.errorhandler(413)
+def _request_too_large(exc):
+    # MAX_CONTENT_LENGTH áp dụng cho mọi route; chỉ route upload ảnh mới báo lỗi theo kiểu "ảnh quá lớn".
+    if request.path.startswith("/extract_schedule"):
+        return _upload_too_large_response()
+    return jsonify({"error": "request_too_large", "message": "Tin nhắn quá dài, bạn rút gọn lại giúp mình nhé."}), 413
+
+
+class IdempotencyStore:
+    """
+    Cache response theo Idempotency-Key, lưu trong SQLite để các worker gunicorn trên cùng máy dùng chung.
+    Mỗi key có trạng thái "pending" (request gốc đang chạy) hoặc "done" (đã có response để trả lại).
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, state TEXT NOT NULL, "
+                "status INTEGER, headers TEXT, body BLOB, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idempotency_expires_at ON idempotency (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def begin(self, key: str, fingerprint: str, pending_ttl: float) -> tuple[str, tuple | None]:
+        # "new" = request này được chạy; "pending" = bản gốc đang chạy; "done" = có response; "mismatch" = key bị dùng lại cho payload khác.
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM idempotency WHERE expires_at < ?", (now,))
+                row = conn.execute(
+                    "SELECT fingerprint, state, status, headers, body FROM idempotency WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    conn.execute(
+                        "INSERT INTO idempotency (key, fingerprint, state, expires_at) VALUES (?, ?, 'pending', ?)",
+                        (key, fingerprint, now + pending_ttl),
+                    )
+                    conn.execute(
+                        "DELETE FROM idempotency WHERE key IN ("
+                        "SELECT key FROM idempotency ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                        (self.max_entries,),
+                    )
+                    conn.execute("COMMIT")
+                    return "new", None
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        stored_fingerprint, state, status, headers, body = row
+        if stored_fingerprint != fingerprint:
+            return "mismatch", None
+        if state == "pending":
+            return "pending", None
+        return "done", (status, json.loads(headers or "{}"), body)
+
+    def complete(self, key: str, status: int, headers: dict, body: bytes) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE idempotency SET state = 'done', status = ?, headers = ?, body = ?, expires_at = ? WHERE key = ?",
+                (status, json.dumps(headers), body, time.time() + self.ttl_seconds, key),
+            )
+
+    def abandon(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM idempotency WHERE key = ? AND state = 'pending'", (key,))
+
+
+IDEMPOTENCY_STORE = None
+IDEMPOTENCY_STORE_LOCK = threading.Lock()
+
+
+def _get_idempotency_store():
+    global IDEMPOTENCY_STORE
+    if IDEMPOTENCY_STORE is not None:
+        return IDEMPOTENCY_STORE
+    with IDEMPOTENCY_STORE_LOCK:
+        if IDEMPOTENCY_STORE is None:
+            try:
+                IDEMPOTENCY_STORE = IdempotencyStore(
+                    IDEMPOTENCY_DB_PATH, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES
+                )
+            except sqlite3.Error as exc:
+                print("[Idempotency] Không mở được cache, bỏ qua Idempotency-Key:", exc)
+                return None
+    return IDEMPOTENCY_STORE
+
+
+def _request_user_id() -> str:
+    if request.mimetype == "multipart/form-data":
+        user_id = request.form.get("user_id")
+    else:
+        payload = request.get_json(silent=True)
+        user_id = payload.get("user_id") if isinstance(payload, dict) else None
+    return user_id or request.args.get("user_id") or request.headers.get("X-User-Id") or request.remote_addr or "anonymous"
+
+
+def _idempotency_fingerprint() -> str:
+    # Upload ảnh không được đọc lại toàn bộ chỉ để hash, nên multipart chỉ so theo độ dài body.
+    if request.mimetype == "multipart/form-data":
+        return f"len:{request.content_length or 0}"
+    return hashlib.sha256(request.get_data(cache=True)).hexdigest()
+
+
+def _replay_response(stored: tuple):
+    status, headers, body = stored
+    response = make_response(body, status)
+    for name, value in headers.items():
+        response.headers[name] = value
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _idempotent(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        raw_key = (request.headers.get("Idempotency-Key") or "").strip()
+        store = _get_idempotency_store() if raw_key else None
+        if store is None:
+            return view(*args, **kwargs)
+
+        key = f"{request.path}:{_request_user_id()}:{raw_key[:200]}"
+        fingerprint = _idempotency_fingerprint()
+        wait_until = time.monotonic() + REQUEST_DEADLINE_SECONDS
+        while True:
+            state, stored = store.begin(key, fingerprint, REQUEST_DEADLINE_SECONDS + 15)
+            if state == "done":
+                return _replay_response(stored)
+            if state == "mismatch":
+                return jsonify({"error": "Idempotency-Key đã được dùng cho một request khác"}), 422
+            if state == "new":
+                break
+            if time.monotonic() >= wait_until:
+                return jsonify({"error": "Request gốc vẫn đang xử lý"}), 409, {"Retry-After": "1"}
+            time.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            store.abandon(key)
+            raise
+        # Lỗi tạm thời (429/5xx) hoặc câu trả lời dự phòng khi LLM lỗi không lưu lại để lần retry sau được chạy thật.
+        if response.status_code == 429 or response.status_code >= 500 or g.pop("idempotency_transient", False):
+            store.abandon(key)
+            return response
+        headers = {name: response.headers[name] for name in IDEMPOTENCY_REPLAY_HEADERS if name in response.headers}
+        store.complete(key, response.status_code, headers, response.get_data())
+        return response
+
+    return wrapper
 
 
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok"}), 200
+    circuits = {
+        breaker.name: breaker.snapshot()
+        for breaker in (GROQ_CHAT_BREAKER, GROQ_VISION_BREAKER, DEEPSEEK_BREAKER)
+    }
+    with EXTRACT_JOBS_LOCK:
+        extract_pending = EXTRACT_PENDING
+    return (
+        jsonify(
+            {
+                "status": "ok",
+                "circuits": circuits,
+                "extract_pending": extract_pending,
+                "admission": LLM_ADMISSION.snapshot(),
+                "chat_cache": CHAT_RESPONSE_CACHE.snapshot(),
+            }
+        ),
+        200,
+    )
 
 
 @app.route("/extract_schedule", methods=["POST"])
+@_idempotent
 def extract_schedule():
+    deadline = _new_deadline()
     if "image" not in request.files:
         return jsonify({"error": "Missing image file"}), 400
 
@@ -777,15 +1741,63 @@ def extract_schedule():
     if not file_storage or file_storage.filename == "":
         return jsonify({"error": "Empty image file"}), 400
 
-    image_bytes = file_storage.read()
+    # Werkzeug đã spool upload lớn ra file tạm; chỉ đọc tối đa giới hạn + 1 byte để biết có vượt không.
+    with _trace_span("upload_read"):
+        image_bytes = file_storage.stream.read(VISION_MAX_IMAGE_BYTES + 1)
+    if len(image_bytes) > VISION_MAX_IMAGE_BYTES:
+        return _upload_too_large_response()
+    if not image_bytes:
+        return jsonify({"error": "Empty image file"}), 400
     mime_type = file_storage.mimetype or "image/jpeg"
 
+    async_mode = request.args.get("async") in ("1", "true") or "respond-async" in request.headers.get("Prefer", "")
+    user_id = _request_user_id()
+    job, rejected = _submit_extraction_job(image_bytes, mime_type, user_id, deadline=None if async_mode else deadline)
+    if rejected == "user_limit":
+        return _admission_rejected_response(rejected)
+    if job is None:
+        return _extraction_busy_response()
+
+    if not async_mode:
+        job["done"].wait(timeout=max(0.0, deadline - time.monotonic()) + 1)
+    if job["status"] == "done":
+        if job["result"].get("image_summary") == FALLBACK_MESSAGE:
+            g.idempotency_transient = True
+        return jsonify(job["result"]), 200
+    if job["status"] == "failed":
+        if job["error"] == "busy":
+            return _extraction_busy_response()
+        return jsonify({"error": job["error"]}), 502
+
+    if not async_mode:
+        # Client đồng bộ (app mobile) chỉ hiểu 200: hết deadline thì trả body dự phòng như trước, job vẫn chạy nền.
+        g.idempotency_transient = True
+        return jsonify({"subjects": [], "image_summary": FALLBACK_MESSAGE}), 200
+    return (
+        jsonify(_extraction_job_payload(job)),
+        202,
+        {"Location": f"/extract_schedule/jobs/{job['id']}", "Retry-After": "1"},
+    )
+
+
+@app.route("/extract_schedule/jobs/<job_id>", methods=["GET"])
+def extract_schedule_job(job_id: str):
+    with EXTRACT_JOBS_LOCK:
+        job = EXTRACT_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
     try:
-        result = _call_ai_with_image(image_bytes, mime_type)
-    except ExtractionError as exc:
-        return jsonify({"error": str(exc)}), 502
+        wait = float(request.args.get("wait") or 0)
+    except ValueError:
+        wait = 0.0
+    wait = max(0.0, min(EXTRACT_MAX_WAIT_SECONDS, wait))
+    if wait:
+        job["done"].wait(timeout=wait)
 
-    return jsonify(result), 200
+    if job["status"] in ("queued", "running"):
+        return jsonify(_extraction_job_payload(job)), 200, {"Retry-After": "1"}
+    return jsonify(_extraction_job_payload(job)), 200
 
 
 def _is_delete_all_schedule_intent(message: str) -> bool:
@@ -812,14 +1824,541 @@ def _is_delete_all_schedule_intent(message: str) -> bool:
     return False
 
 
+def _fold_text(value: str) -> str:
+    # Bỏ dấu tiếng Việt + lowercase để so khớp "Thứ 2" / "thu 2" / "THỨ HAI" như nhau.
+    text = unicodedata.normalize("NFD", value.replace("đ", "d").replace("Đ", "D"))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.lower().split())
+
+
+_DAY_WORDS = {"hai": 0, "ba": 1, "tu": 2, "nam": 3, "sau": 4, "bay": 5}
+_DAY_ENGLISH = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+def _normalize_day_of_week(value) -> str | None:
+    if not isinstance(value, str):
+        return None
+    text = _fold_text(value)
+    if text in ("cn", "chu nhat", "sunday", "sun"):
+        return WEEKDAY_NAMES[6]
+    if text in _DAY_ENGLISH:
+        return WEEKDAY_NAMES[_DAY_ENGLISH.index(text)]
+    m = re.fullmatch(r"(?:thu|t)?\s*([2-7])", text)
+    if m:
+        return WEEKDAY_NAMES[int(m.group(1)) - 2]
+    m = re.fullmatch(r"thu\s+(hai|ba|tu|nam|sau|bay)", text)
+    if m:
+        return WEEKDAY_NAMES[_DAY_WORDS[m.group(1)]]
+    return None
+
+
+def _normalize_hhmm(value) -> str | None:
+    if not isinstance(value, str):
+        return None
+    m = re.fullmatch(r"\s*(\d{1,2})\s*[:hH]\s*(\d{1,2})?\s*", value)
+    if not m:
+        return None
+    h = int(m.group(1))
+    mi = int(m.group(2) or 0)
+    if h > 23 or mi > 59:
+        return None
+    return f"{h:02d}:{mi:02d}"
+
+
+def _normalize_specific_date(value) -> str:
+    if not isinstance(value, str) or not value.strip():
+        return ""
+    text = value.strip()
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return ""
+
+
+def _hhmm_to_minutes(value: str) -> int:
+    return int(value[:2]) * 60 + int(value[3:5])
+
+
+def _normalize_subject(subject) -> dict | None:
+    # Trả về bản chuẩn hóa của một subject, hoặc None nếu không đọc được tên/giờ bắt đầu/ngày.
+    if not isinstance(subject, dict):
+        return None
+    name = str(subject.get("name") or "").strip()
+    start_time = _normalize_hhmm(subject.get("start_time"))
+    if not name or start_time is None:
+        return None
+    specific_date = _normalize_specific_date(subject.get("specific_date"))
+    day_of_week = _normalize_day_of_week(subject.get("day_of_week"))
+    if specific_date:
+        # Ngày cụ thể là nguồn sự thật, thứ phải khớp với ngày.
+        day_of_week = WEEKDAY_NAMES[datetime.strptime(specific_date, "%Y-%m-%d").weekday()]
+    if day_of_week is None:
+        return None
+    # Giờ kết thúc nhỏ hơn giờ bắt đầu là ca qua đêm (22:00-02:00), chỉ bỏ khi không đọc được hoặc trùng giờ bắt đầu.
+    end_time = _normalize_hhmm(subject.get("end_time")) or ""
+    if end_time == start_time:
+        end_time = ""
+    return {
+        "name": name,
+        "day_of_week": day_of_week,
+        "start_time": start_time,
+        "end_time": end_time,
+        "room": str(subject.get("room") or "").strip(),
+        "specific_date": specific_date,
+    }
+
+
+def _normalize_subjects(subjects, keep_unparsed=None) -> list[dict]:
+    """
+    Chuẩn hóa subjects do LLM trả về: giờ HH:MM, day_of_week dạng "Thứ N"/"Chủ nhật",
+    specific_date dạng YYYY-MM-DD. Entry không đọc được sẽ bị bỏ, trừ khi nó có nguyên văn
+    trong keep_unparsed (lịch gốc của người dùng) thì được giữ nguyên không sửa.
+    """
+    if not isinstance(subjects, list):
+        return []
+    kept_raw = keep_unparsed or []
+    normalized = []
+    seen = set()
+    for subject in subjects:
+        item = _normalize_subject(subject)
+        if item is None:
+            if isinstance(subject, dict) and subject in kept_raw and subject not in normalized:
+                normalized.append(subject)
+            continue
+        key = (
+            item["name"].lower(),
+            item["day_of_week"],
+            item["start_time"],
+            item["end_time"],
+            item["room"].lower(),
+            item["specific_date"],
+        )
+        if key in seen:
+            continue
+        seen.add(key)
+        normalized.append(item)
+    return normalized
+
+
+def _subject_key(subject: dict) -> tuple:
+    return (
+        subject.get("name", "").lower(),
+        subject.get("day_of_week", ""),
+        subject.get("start_time", ""),
+        subject.get("end_time", ""),
+        subject.get("room", "").lower(),
+        subject.get("specific_date", ""),
+    )
+
+
+def _subject_intervals(subject: dict) -> list[tuple[str, int, int, str]]:
+    # (thứ, phút bắt đầu, phút kết thúc, specific_date) của từng ngày mà subject chiếm.
+    # Ca qua đêm (22:00-02:00) tách thành phần tới 24:00 và phần sáng hôm sau để so với lịch của ngày kế tiếp.
+    day = subject["day_of_week"]
+    date_str = subject["specific_date"]
+    start = _hhmm_to_minutes(subject["start_time"])
+    end = _hhmm_to_minutes(subject["end_time"]) if subject["end_time"] else start
+    if end >= start:
+        return [(day, start, end, date_str)]
+    intervals = [(day, start, 24 * 60, date_str)]
+    if end > 0:
+        next_day = WEEKDAY_NAMES[(WEEKDAY_NAMES.index(day) + 1) % 7]
+        next_date = ""
+        if date_str:
+            next_date = (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        intervals.append((next_day, 0, end, next_date))
+    return intervals
+
+
+class ScheduleIndex:
+    """
+    Interval index theo từng ngày trong tuần cho subjects đã chuẩn hóa.
+    Mỗi ngày giữ danh sách interval sắp theo giờ bắt đầu cùng prefix-max của giờ kết thúc.
+    Tìm xung đột: bisect O(log n) cho các interval bắt đầu trong khoảng của subject, cộng một lượt
+    quét lùi qua các interval bắt đầu sớm hơn khi prefix-max còn chạm tới giờ bắt đầu. Lượt quét này
+    không chỉ đi qua interval xung đột nên trường hợp xấu (một interval rất dài từ sớm) vẫn là O(n);
+    lịch mỗi người chỉ vài chục mục nên chấp nhận được.
+    """
+
+    def __init__(self, subjects: list[dict]):
+        buckets: dict[str, list[tuple[int, int, int, str]]] = {}
+        for position, subject in enumerate(subjects):
+            for day, start, end, date_str in _subject_intervals(subject):
+                buckets.setdefault(day, []).append((start, end, position, date_str))
+        self.subjects = subjects
+        self._days = {}
+        for day, intervals in buckets.items():
+            intervals.sort()
+            max_ends = []
+            running = -1
+            for _, end, _, _ in intervals:
+                running = max(running, end)
+                max_ends.append(running)
+            self._days[day] = ([item[0] for item in intervals], intervals, max_ends)
+
+    def _overlapping(self, day: str, start: int, end: int, window: int) -> list[tuple[tuple, bool]]:
+        bucket = self._days.get(day)
+        if bucket is None:
+            return []
+        starts, intervals, max_ends = bucket
+        lo = bisect.bisect_left(starts, start - window)
+        hi = bisect.bisect_left(starts, max(end, start + window + 1))
+        found = [(intervals[i], abs(intervals[i][0] - start) <= window) for i in range(lo, hi)]
+        # Các interval bắt đầu sớm hơn nhưng kéo dài qua giờ bắt đầu: dừng khi prefix-max không còn chạm tới.
+        j = lo - 1
+        while j >= 0 and max_ends[j] > start:
+            if intervals[j][1] > start:
+                found.append((intervals[j], False))
+            j -= 1
+        return found
+
+    def conflicts(self, position: int) -> list[tuple[int, bool]]:
+        # Trả về (vị trí subject xung đột, có phải gần trùng ±CONFLICT_WINDOW_MINUTES hay không).
+        result: dict[int, bool] = {}
+        for index, (day, start, end, date_str) in enumerate(_subject_intervals(self.subjects[position])):
+            # Phần sáng hôm sau của ca qua đêm không có giờ bắt đầu thật nên chỉ xét chồng lấn.
+            window = CONFLICT_WINDOW_MINUTES if index == 0 else 0
+            for (_, _, other, other_date), near in self._overlapping(day, start, end, window):
+                if other == position or (date_str and other_date and other_date != date_str):
+                    continue
+                result[other] = result.get(other, False) or near
+        return list(result.items())
+
+
+def _build_conflict_warnings(original_subjects: list, new_subjects: list) -> list[str]:
+    # Chỉ xét các entry chuẩn hóa được; entry giữ nguyên văn không có giờ rõ ràng để so.
+    original_subjects = _normalize_subjects(original_subjects)
+    new_subjects = _normalize_subjects(new_subjects)
+    original_keys = {_subject_key(subject) for subject in original_subjects}
+    changed = [i for i, subject in enumerate(new_subjects) if _subject_key(subject) not in original_keys]
+    if not changed:
+        return []
+    index = ScheduleIndex(new_subjects)
+    warnings = []
+    reported = set()
+    for position in changed:
+        subject = new_subjects[position]
+        for other, near in index.conflicts(position):
+            pair = frozenset((position, other))
+            if pair in reported:
+                continue
+            reported.add(pair)
+            other_subject = new_subjects[other]
+            relation = "đang gần trùng với" if near else "đang trùng khung giờ với"
+            warnings.append(
+                f"Lưu ý: {subject['name']} lúc {subject['start_time']} ({subject['day_of_week']}) "
+                f"{relation} lịch {other_subject['name']} lúc {other_subject['start_time']}."
+            )
+    if len(warnings) > MAX_CONFLICT_WARNINGS:
+        extra = len(warnings) - MAX_CONFLICT_WARNINGS
+        warnings = warnings[:MAX_CONFLICT_WARNINGS] + [f"...và {extra} chỗ trùng lịch khác."]
+    return warnings
+
+
+def _subjects_signature(subjects: list[dict]) -> str:
+    return hashlib.sha256(_json_dumps(subjects, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _expand_occurrences(subjects: list[dict], window_start: date, days: int) -> list[dict]:
+    # Mở rộng subjects (đã chuẩn hóa) thành các buổi cụ thể theo giờ Việt Nam trong [window_start, window_start + days).
+    weekly: dict[str, list[dict]] = {}
+    dated: dict[str, list[dict]] = {}
+    for subject in subjects:
+        if subject["specific_date"]:
+            dated.setdefault(subject["specific_date"], []).append(subject)
+        else:
+            weekly.setdefault(subject["day_of_week"], []).append(subject)
+
+    occurrences = []
+    for offset in range(days):
+        day = window_start + timedelta(days=offset)
+        day_key = day.isoformat()
+        for subject in weekly.get(WEEKDAY_NAMES[day.weekday()], []) + dated.get(day_key, []):
+            start_min = _hhmm_to_minutes(subject["start_time"])
+            start = datetime(day.year, day.month, day.day, start_min // 60, start_min % 60, tzinfo=VN_TZ)
+            end = None
+            if subject["end_time"]:
+                end_min = _hhmm_to_minutes(subject["end_time"])
+                end = datetime(day.year, day.month, day.day, end_min // 60, end_min % 60, tzinfo=VN_TZ)
+                if end < start:
+                    end += timedelta(days=1)
+            occurrences.append(
+                {
+                    "name": subject["name"],
+                    "room": subject["room"],
+                    "date": day_key,
+                    "day_of_week": subject["day_of_week"],
+                    "start_time": subject["start_time"],
+                    "end_time": subject["end_time"],
+                    "start": start,
+                    "end": end,
+                }
+            )
+    occurrences.sort(key=lambda item: (item["start"], item["name"]))
+    return occurrences
+
+
+OCCURRENCE_CACHE: OrderedDict[str, tuple[str, date, list[dict]]] = OrderedDict()
+OCCURRENCE_CACHE_LOCK = threading.Lock()
+
+
+def _get_user_occurrences(user_id: str, subjects: list[dict], today: date) -> list[dict]:
+    # Cache theo user; chỉ tính lại khi tập subjects đổi hoặc sang ngày mới (cửa sổ dịch đi).
+    signature = _subjects_signature(subjects)
+    with OCCURRENCE_CACHE_LOCK:
+        cached = OCCURRENCE_CACHE.get(user_id)
+        if cached is not None and cached[0] == signature and cached[1] == today:
+            OCCURRENCE_CACHE.move_to_end(user_id)
+            return cached[2]
+    occurrences = _expand_occurrences(subjects, today, OCCURRENCE_WINDOW_DAYS)
+    with OCCURRENCE_CACHE_LOCK:
+        OCCURRENCE_CACHE[user_id] = (signature, today, occurrences)
+        OCCURRENCE_CACHE.move_to_end(user_id)
+        while len(OCCURRENCE_CACHE) > OCCURRENCE_CACHE_MAX_USERS:
+            OCCURRENCE_CACHE.popitem(last=False)
+    return occurrences
+
+
+def _next_occurrences(occurrences: list[dict], now: datetime, limit: int) -> list[dict]:
+    upcoming = []
+    for item in occurrences:
+        if (item["end"] or item["start"]) < now:
+            continue
+        upcoming.append(item)
+        if len(upcoming) >= limit:
+            break
+    return upcoming
+
+
+def _occurrence_payload(item: dict) -> dict:
+    payload = dict(item)
+    payload["start"] = item["start"].isoformat()
+    payload["end"] = item["end"].isoformat() if item["end"] else None
+    return payload
+
+
+def _build_upcoming_block(occurrences: list[dict], now: datetime, days: list[date] | None = None) -> str:
+    # Mặc định chỉ gửi hôm nay/ngày mai; câu hỏi về thứ cụ thể hoặc cả tuần truyền thêm các ngày cần xem.
+    today = now.date()
+    lines = []
+    for day in days or (today, today + timedelta(days=1)):
+        day_key = day.isoformat()
+        items = [
+            f"{item['start_time']}{'-' + item['end_time'] if item['end_time'] else ''} {item['name']}"
+            f"{' (' + item['room'] + ')' if item['room'] else ''}"
+            for item in occurrences
+            if item["date"] == day_key
+        ]
+        label = {0: "Hôm nay", 1: "Ngày mai"}.get((day - today).days, "")
+        header = f"{label + ' (' if label else ''}{WEEKDAY_NAMES[day.weekday()]}, {day.strftime('%d/%m')}{')' if label else ''}"
+        lines.append(f"{header}: {'; '.join(items) if items else 'không có lịch'}")
+    return "\n".join(lines)
+
+
+# App mobile nối thêm mô tả cá tính vào cuối mỗi tin nhắn; phải bỏ đi trước khi đoán ý định hay tính cache key.
+_PERSONA_CONTEXT_SUFFIX_RE = re.compile(r"\s*Cá tính hiện tại của bạn là:.*\Z", re.S)
+_SCHEDULE_QUERY_MARKERS = (
+    "co gi",
+    "lich gi",
+    "xem lich",
+    "xem lai lich",
+    "lich hom nay",
+    "lich ngay mai",
+    "lich mai",
+    "may gio",
+    "khi nao",
+)
+_SCHEDULE_EDIT_MARKERS = (
+    "them",
+    "xoa",
+    "doi",
+    "sua",
+    "huy",
+    "nhac",
+    "nua",
+    "dat lich",
+    "tao lich",
+    "sap lich",
+    "sap xep",
+    "xep lich",
+    "lam lai",
+    "moi ngay",
+    "hang ngay",
+)
+
+
+def _contains_marker(folded_text: str, markers) -> bool:
+    # Marker một từ so theo từ nguyên vẹn, marker nhiều từ so theo chuỗi con.
+    words = set(re.findall(r"[a-z]+", folded_text))
+    return any((marker in words) if " " not in marker else (marker in folded_text) for marker in markers)
+
+
+def _has_schedule_edit_marker(folded_text: str) -> bool:
+    return _contains_marker(folded_text, _SCHEDULE_EDIT_MARKERS)
+
+
+_QUERY_WEEKDAY_RE = re.compile(r"\b(?:thu\s*(?:[2-7]|hai|ba|tu|nam|sau|bay)|chu nhat|cn)\b")
+# Câu có giờ, phòng, tiết... thường là đang kể lịch mới ("thứ 2 tao có lịch học toán 7h phòng A1").
+_QUERY_DETAIL_RE = re.compile(r"\d|\b(?:luc|phut|phong|tiet|tu|den)\b")
+_QUERY_OUT_OF_WINDOW = ("hom qua", "tuan truoc", "tuan sau", "tuan toi", "thang")
+
+
+def _schedule_query_days(message: str, today: date) -> list[date] | None:
+    """
+    Nếu tin nhắn chỉ là câu hỏi xem lịch ("mai tao có gì", "thứ 6 tao có gì", "xem lại lịch tuần này")
+    thì trả về các ngày cần gửi lịch tính sẵn; None khi có thể là câu thêm/sửa lịch hoặc hỏi ngoài cửa sổ.
+    """
+    text = _fold_text(_PERSONA_CONTEXT_SUFFIX_RE.sub("", message or ""))
+    if not any(marker in text for marker in _SCHEDULE_QUERY_MARKERS) or _has_schedule_edit_marker(text):
+        return None
+    if any(marker in text for marker in _QUERY_OUT_OF_WINDOW):
+        return None
+    weekday_match = _QUERY_WEEKDAY_RE.search(text)
+    if _QUERY_DETAIL_RE.search(_QUERY_WEEKDAY_RE.sub(" ", text)):
+        return None
+    if "tuan" in text:
+        return [today + timedelta(days=offset) for offset in range(7)]
+    days = [today, today + timedelta(days=1)]
+    if "ngay kia" in text:
+        days.append(today + timedelta(days=2))
+    if weekday_match:
+        target = WEEKDAY_NAMES.index(_normalize_day_of_week(weekday_match.group(0)))
+        day = today + timedelta(days=(target - today.weekday()) % 7)
+        if day not in days:
+            days.append(day)
+    return days
+
+
+class ResponseCache:
+    """
+    LRU + TTL cache cho câu trả lời chat không phụ thuộc lịch, kèm số liệu hit/miss.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> str | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, reply: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, reply)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+CHAT_RESPONSE_CACHE = ResponseCache(CHAT_CACHE_TTL_SECONDS, CHAT_CACHE_MAX_ENTRIES)
+
+
+# Câu trả lời phụ thuộc thời điểm hỏi hoặc ngữ cảnh trước đó thì không cache.
+_CHAT_CACHE_CONTEXT_MARKERS = (
+    "hom nay",
+    "ngay mai",
+    "hom qua",
+    "bay gio",
+    "luc nay",
+    "may gio",
+    "thu may",
+    "ngay may",
+    "tuan nay",
+    "thang nay",
+    "nam nay",
+    "mai",
+    "tiep di",
+    "tiep tuc",
+    "lam tiep",
+    "cau a",
+    "cau b",
+    "cau c",
+    "cau d",
+    "cau tren",
+    "bai tren",
+    "o tren",
+    "thi sao",
+    "vua roi",
+    "nhu vay",
+)
+
+
+def _has_prior_user_turns(history: list, message: str) -> bool:
+    # App mobile luôn gửi kèm lời chào của KairoAI và bản sao tin nhắn hiện tại ở cuối history; hai thứ đó không tính.
+    user_turns = [
+        str(item.get("content") or "").strip()
+        for item in history
+        if isinstance(item, dict) and item.get("role") == "user"
+    ]
+    if user_turns and user_turns[-1] == message.strip():
+        user_turns.pop()
+    return any(user_turns)
+
+
+def _chat_cache_key(message: str, persona: str, time_mode: str, history: list) -> str | None:
+    # Chỉ cache câu hỏi mở đầu cuộc trò chuyện, ngắn, không đụng tới lịch hay thời điểm hiện tại.
+    if not CHAT_CACHE_ENABLED or not message:
+        return None
+    message = _PERSONA_CONTEXT_SUFFIX_RE.sub("", message)
+    if _has_prior_user_turns(history, message):
+        return None
+    if not message or len(message) > CHAT_CACHE_MAX_MESSAGE_CHARS:
+        return None
+    text = _fold_text(message)
+    if re.search(r"\d", text) or "lich" in text:
+        return None
+    if any(marker in text for marker in _SCHEDULE_QUERY_MARKERS):
+        return None
+    if _has_schedule_edit_marker(text) or _contains_marker(text, _CHAT_CACHE_CONTEXT_MARKERS):
+        return None
+    normalized = " ".join(re.findall(r"[a-z]+", text))
+    if not normalized:
+        return None
+    raw_key = f"{CHAT_PROMPT_VERSION}|{CHAT_MODEL}|{persona}|{time_mode}|{normalized}"
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
 def _sync_subjects_to_firestore(user_id: str, subjects: list[dict]) -> bool:
     try:
-        db = _get_firestore_client()
+        with _trace_span("firestore_init"):
+            db = _get_firestore_client()
         if db is None:
             return False
         col = db.collection("users").document(user_id).collection("schedules")
         batch = db.batch()
-        docs = col.stream()
+        with _trace_span("firestore_read"):
+            docs = list(col.stream())
         for doc in docs:
             batch.delete(doc.reference)
         for subject in subjects:
@@ -833,25 +2372,103 @@ def _sync_subjects_to_firestore(user_id: str, subjects: list[dict]) -> bool:
             }
             doc_ref = col.document()
             batch.set(doc_ref, data)
-        batch.commit()
+        with _trace_span("firestore_commit"):
+            batch.commit()
         return True
     except Exception as exc:
         print("[Firebase] Sync subjects failed, fallback to client mode:", exc)
         return False
 
 
+def _load_subjects_from_firestore(user_id: str) -> list[dict] | None:
+    try:
+        with _trace_span("firestore_init"):
+            db = _get_firestore_client()
+        if db is None:
+            return None
+        col = db.collection("users").document(user_id).collection("schedules")
+        with _trace_span("firestore_read"):
+            return [doc.to_dict() or {} for doc in col.stream()]
+    except Exception as exc:
+        print("[Firebase] Load subjects failed:", exc)
+        return None
+
+
 def clear_all_events(user_id: str) -> bool:
     return _sync_subjects_to_firestore(user_id, [])
 
 
+@app.route("/occurrences", methods=["GET", "POST"])
+def occurrences():
+    payload = request.get_json(silent=True) if request.method == "POST" else None
+    if not isinstance(payload, dict):
+        payload = {}
+    user_id = _request_user_id()
+    try:
+        limit = int(payload.get("limit") or request.args.get("limit") or 10)
+    except (TypeError, ValueError):
+        limit = 10
+    limit = max(1, min(OCCURRENCE_MAX_LIMIT, limit))
+
+    raw_subjects = payload.get("subjects")
+    if raw_subjects is None:
+        raw_subjects = _load_subjects_from_firestore(user_id)
+        if raw_subjects is None:
+            return jsonify({"error": "Missing subjects"}), 400
+    subjects = _normalize_subjects(raw_subjects)
+
+    now_vn = datetime.now(VN_TZ)
+    items = _next_occurrences(_get_user_occurrences(user_id, subjects, now_vn.date()), now_vn, limit)
+    return jsonify({"occurrences": [_occurrence_payload(item) for item in items]}), 200
+
+
+@app.route("/admin/usage", methods=["GET"])
+def admin_usage():
+    if not ADMIN_TOKEN or not hmac.compare_digest(
+        request.headers.get("X-Admin-Token", "").encode("utf-8"), ADMIN_TOKEN.encode("utf-8")
+    ):
+        return jsonify({"error": "Forbidden"}), 403
+
+    def _usage(dimension: str, ident: str) -> dict:
+        return {window: USAGE_LEDGER.totals(dimension, ident, window) for window in UsageLedger.WINDOWS}
+
+    user_id = request.args.get("user_id")
+    if user_id:
+        return jsonify({"user_id": user_id, "usage": _usage("user", user_id), "policy": _usage_policy(user_id)}), 200
+
+    try:
+        limit = max(1, min(200, int(request.args.get("limit") or 20)))
+    except ValueError:
+        limit = 20
+    users = [(ident, _usage("user", ident)) for ident in USAGE_LEDGER.idents("user")]
+    users.sort(key=lambda item: item[1]["day"]["total_tokens"], reverse=True)
+    return (
+        jsonify(
+            {
+                "keys": {
+                    label: dict(_usage("key", label), pressure=round(_key_pressure(label), 3))
+                    for label in USAGE_LEDGER.idents("key")
+                },
+                "models": {model: _usage("model", model) for model in USAGE_LEDGER.idents("model")},
+                "top_users": [{"user_id": ident, "usage": usage} for ident, usage in users[:limit]],
+            }
+        ),
+        200,
+    )
+
+
 @app.route("/chat", methods=["POST"])
+@_idempotent
 def chat():
+    deadline = _new_deadline()
     payload = request.get_json(silent=True) or {}
     persona = payload.get("persona") or "serious"
     history = payload.get("history") or []
     message = payload.get("message") or ""
     subjects = payload.get("subjects") or []
-    user_id = payload.get("user_id") or request.headers.get("X-User-Id") or request.remote_addr or "anonymous"
+    if not isinstance(subjects, list):
+        subjects = []
+    user_id = _request_user_id()
 
     now_vn = datetime.now(VN_TZ)
     hour = now_vn.hour
@@ -889,12 +2506,51 @@ def chat():
     if not message:
         return jsonify({"error": "Empty message"}), 400
 
+    policy = _usage_policy(user_id)
+    if policy == "block":
+        return (
+            jsonify(
+                {
+                    "error": "quota_exceeded",
+                    "message": "Hôm nay bạn đã dùng hết lượt trò chuyện, mai quay lại với mình nhé.",
+                }
+            ),
+            429,
+        )
+
+    cache_key = _chat_cache_key(message, persona, time_mode, history) if policy == "ok" else None
+    if cache_key:
+        cached_reply = CHAT_RESPONSE_CACHE.get(cache_key)
+        if cached_reply is not None:
+            return jsonify({"reply": cached_reply, "subjects": subjects, "needs_sync": False}), 200
+
+    with _trace_span("admission"):
+        rejected = LLM_ADMISSION.acquire("chat", user_id, ADMISSION_MAX_WAIT_SECONDS)
+    if rejected:
+        return _admission_rejected_response(rejected)
+    user_token = _CURRENT_USER.set(user_id)
     try:
-        result = _call_ai_for_chat(persona, history, message, subjects, time_mode, current_time_str)
+        result = _call_ai_for_chat(
+            persona,
+            history,
+            message,
+            subjects,
+            time_mode,
+            current_time_str,
+            deadline=deadline,
+            user_id=user_id,
+            short_reply=policy == "short",
+            cache_key=cache_key,
+        )
     except ExtractionError as exc:
         return jsonify({"error": str(exc)}), 502
+    finally:
+        _CURRENT_USER.reset(user_token)
+        LLM_ADMISSION.release("chat", user_id)
 
     reply = result.get("reply") or "KairoAI đã nhận được yêu cầu của đại ca."
+    if reply == FALLBACK_MESSAGE:
+        g.idempotency_transient = True
     subjects_result = result.get("subjects", None)
     if isinstance(subjects_result, list):
         new_subjects = subjects_result
@@ -904,10 +2560,15 @@ def chat():
     if _is_delete_all_schedule_intent(message):
         new_subjects = []
 
+    new_subjects = _normalize_subjects(new_subjects, keep_unparsed=subjects)
+    warnings = _build_conflict_warnings(subjects, new_subjects)
+    if warnings:
+        reply = reply.rstrip() + "\n\n" + "\n".join(warnings)
+
     needs_sync = False
     try:
-        original_sig = json.dumps(subjects, ensure_ascii=False, sort_keys=True)
-        new_sig = json.dumps(new_subjects, ensure_ascii=False, sort_keys=True)
+        original_sig = _json_dumps(subjects, sort_keys=True)
+        new_sig = _json_dumps(new_subjects, sort_keys=True)
     except TypeError:
         original_sig = ""
         new_sig = ""
@@ -0,0 +1,22 @@
+import os
+
+# Job trích xuất ảnh (EXTRACT_JOBS), admission control, usage ledger, circuit breaker và các cache
+# đều giữ state trong bộ nhớ process, nên backend chạy đúng MỘT process với nhiều thread (gthread).
+# Long-poll /extract_schedule/jobs/<id>?wait=... chỉ giữ một thread, /chat vẫn được các thread khác phục vụ.
+# workers cố định ở đây để WEB_CONCURRENCY do buildpack tự đặt không nhân thành nhiều process.
+worker_class = "gthread"
+workers = 1
+
+# Phải nhiều hơn LLM_MAX_INFLIGHT: khi đủ slot LLM, các thread còn lại vẫn nhận request để
+# AdmissionController trả 429/503 ngay, phục vụ /health, long-poll job và cache hit.
+_LLM_MAX_INFLIGHT = int(os.environ.get("LLM_MAX_INFLIGHT", "12"))
+threads = max(int(os.environ.get("GUNICORN_THREADS", "16")), _LLM_MAX_INFLIGHT + 4)
+
+
+def on_starting(server):
+    # Quota token/request của UsageLedger và admission chỉ đúng khi mọi request đi qua cùng một process.
+    if server.cfg.workers != 1:
+        raise RuntimeError(
+            f"Backend chỉ hỗ trợ 1 worker process (đang cấu hình {server.cfg.workers}); "
+            "tăng GUNICORN_THREADS thay vì số worker."
+        )
@@ -0,0 +1,45 @@
+import pytest
+
+import app
+
+# Giống chuỗi personaContext mà mobile/lib/chat_page.dart nối vào cuối mỗi tin nhắn.
+PERSONA_SUFFIX = (
+    "\n\nCá tính hiện tại của bạn là: Nghiêm túc. Mày là một trợ lý AI chuẩn mực, chuyên nghiệp và điềm đạm. "
+    "Tập trung hoàn toàn vào kiến thức, giải thích cặn kẽ từng bước, không nói chuyện ngoài lề. "
+    "Phong cách: hầu như không dùng icon, nếu cần thì chỉ dùng 📝 hoặc ✅. "
+    "Hãy trả lời đúng với cá tính này, trừ khi người dùng yêu cầu một phong cách khác rõ ràng."
+)
+GREETING = {"role": "assistant", "content": "KaironAI đã sẵn sàng phục vụ. Cá tính hiện tại: Nghiêm túc."}
+
+
+@pytest.fixture(autouse=True)
+def _enable_cache(monkeypatch):
+    monkeypatch.setattr(app, "CHAT_CACHE_ENABLED", True)
+
+
+def _mobile_key(text, earlier=()):
+    history = [GREETING, *earlier, {"role": "user", "content": text}]
+    return app._chat_cache_key(text + PERSONA_SUFFIX, "serious", "day", history)
+
+
+@pytest.mark.parametrize("text", ["mày là ai", "app này làm gì", "công thức tính nhiệt độ sôi là gì"])
+def test_stateless_mobile_questions_get_a_key(text):
+    assert _mobile_key(text) is not None
+
+
+def test_key_ignores_persona_suffix_and_diacritics():
+    assert _mobile_key("Mày là ai?") == _mobile_key("may la ai")
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["hôm nay thứ mấy", "bây giờ là mấy giờ", "mai tao có gì", "thêm lịch học toán", "giải bài 3"],
+)
+def test_time_and_schedule_questions_are_not_cached(text):
+    assert _mobile_key(text) is None
+
+
+@pytest.mark.parametrize("text", ["tiếp đi", "câu b thì sao", "mày là ai"])
+def test_follow_up_turns_are_not_cached(text):
+    earlier = [{"role": "user", "content": "giải giúp tao đề này"}, {"role": "assistant", "content": "..."}]
+    assert _mobile_key(text, earlier) is None
@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from app import ExtractionError, _decode_llm_json, _parse_ai_response, _parse_vision_response
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        "{oops",
+        "Đáp án: tập nghiệm là {1, 2}.",
+        "def f(x): return {x: 1}",
+        "Không có JSON nào ở đây.",
+        '{"foo": 1}',
+    ],
+)
+def test_non_json_replies_raise(raw):
+    with pytest.raises(ExtractionError):
+        _decode_llm_json(raw)
+
+
+def test_plain_object():
+    assert _decode_llm_json('{"reply": "ok", "subjects": []}') == ({"reply": "ok", "subjects": []}, False)
+
+
+def test_latex_invalid_escape_is_repaired():
+    raw = '{"reply": "Ta có \\(x^2 + 1\\) > 0", "subjects": []}'
+    parsed, truncated = _decode_llm_json(raw)
+    assert parsed["reply"] == "Ta có \\(x^2 + 1\\) > 0"
+    assert parsed["subjects"] == []
+    assert truncated is False
+
+
+def test_valid_escaped_backslash_is_kept():
+    raw = '{"reply": "C:\\\\temp \\\\(x\\\\)", "subjects": []}'
+    assert _decode_llm_json(raw)[0]["reply"] == "C:\\temp \\(x\\)"
+
+
+def test_prose_with_braces_before_json():
+    parsed, truncated = _decode_llm_json('Here {is} it: {"reply": "ok", "subjects": []} and {more}')
+    assert parsed == {"reply": "ok", "subjects": []}
+    assert truncated is False
+
+
+def test_prose_with_json_like_object_before_answer():
+    raw = 'Ví dụ {"a": 1} rồi mới tới {"reply": "ok", "subjects": []}'
+    assert _decode_llm_json(raw)[0] == {"reply": "ok", "subjects": []}
+
+
+def test_outer_fence_stripped_inner_fence_kept():
+    body = {"reply": "Ví dụ:\n```python\nprint(1)\n```", "subjects": []}
+    raw = "```json\n" + json.dumps(body, ensure_ascii=False) + "\n```"
+    assert _decode_llm_json(raw) == (body, False)
+
+
+def test_truncated_inside_reply_keeps_text():
+    parsed, truncated = _decode_llm_json('{"reply": "Đây là lời giải dài')
+    assert truncated is True
+    assert parsed == {"reply": "Đây là lời giải dài"}
+
+
+def test_truncated_inside_subjects_drops_partial_schedule():
+    raw = '{"reply": "ok", "subjects": [{"name": "Toán", "start_time": "07:00"}, {"name": "L'
+    parsed, truncated = _decode_llm_json(raw)
+    assert truncated is True
+    assert parsed["subjects"] == [{"name": "Toán", "start_time": "07:00"}]
+    assert _parse_ai_response(raw)["subjects"] is None
+
+
+def test_truncated_before_any_value_raises():
+    with pytest.raises(ExtractionError):
+        _decode_llm_json('{"reply"')
+
+
+def test_parse_ai_response_raises_for_plain_text():
+    # _call_ai_for_chat dựa vào lỗi này để trả nguyên văn câu trả lời thay vì câu mặc định.
+    with pytest.raises(ExtractionError):
+        _parse_ai_response("Đáp án: tập nghiệm là {1, 2}.")
+
+
+def test_vision_expects_its_own_keys():
+    parsed = _parse_vision_response('{"image_summary": "Lịch học"}')
+    assert parsed == {"image_summary": "Lịch học", "subjects": []}
+    with pytest.raises(ExtractionError):
+        _parse_vision_response('{"reply": "ok"}')
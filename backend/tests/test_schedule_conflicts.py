@@ -0,0 +1,50 @@
+from app import ScheduleIndex, _build_conflict_warnings
+
+
+def _subject(name, day, start, end="", specific_date=""):
+    return {
+        "name": name,
+        "day_of_week": day,
+        "start_time": start,
+        "end_time": end,
+        "room": "",
+        "specific_date": specific_date,
+    }
+
+
+def test_overnight_slot_conflicts_with_next_morning():
+    subjects = [_subject("Ca đêm", "Thứ 2", "22:00", "02:00"), _subject("Gym", "Thứ 3", "01:00", "01:30")]
+    index = ScheduleIndex(subjects)
+    assert index.conflicts(0) == [(1, False)]
+    assert index.conflicts(1) == [(0, False)]
+
+
+def test_overnight_sunday_wraps_to_monday():
+    subjects = [_subject("Trực", "Chủ nhật", "23:00", "01:00"), _subject("Chạy bộ", "Thứ 2", "00:30")]
+    assert ScheduleIndex(subjects).conflicts(0) == [(1, False)]
+
+
+def test_dated_overnight_only_hits_the_following_date():
+    subjects = [
+        _subject("Trực", "Thứ 2", "22:00", "02:00", "2026-10-19"),
+        _subject("Khám", "Thứ 3", "01:00", "", "2026-10-20"),
+        _subject("Khám", "Thứ 3", "01:00", "", "2026-10-27"),
+    ]
+    assert ScheduleIndex(subjects).conflicts(0) == [(1, False)]
+
+
+def test_near_and_overlapping_entries():
+    subjects = [
+        _subject("Họp", "Thứ 2", "09:00", "10:00"),
+        _subject("Học", "Thứ 2", "09:03", "11:00"),
+        _subject("Dài", "Thứ 2", "07:00", "12:00"),
+        _subject("Trưa", "Thứ 2", "12:00", "13:00"),
+    ]
+    assert sorted(ScheduleIndex(subjects).conflicts(0)) == [(1, True), (2, False)]
+
+
+def test_warnings_only_for_changed_entries():
+    original = [_subject("Họp", "Thứ 2", "09:00", "10:00"), _subject("Dài", "Thứ 2", "07:00", "12:00")]
+    assert _build_conflict_warnings(original, original) == []
+    warnings = _build_conflict_warnings(original, original + [_subject("Học", "Thứ 2", "09:30")])
+    assert len(warnings) == 2
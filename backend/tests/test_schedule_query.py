@@ -0,0 +1,49 @@
+from datetime import date
+
+import pytest
+
+from app import _schedule_query_days
+
+# Các câu personaInstruction trong mobile/lib/chat_page.dart, app nối vào cuối mỗi tin nhắn.
+PERSONA_INSTRUCTIONS = {
+    "funny": (
+        "Mày là một chuyên gia giải toán nhưng có tâm hồn của một TikToker triệu view. Cách nói chuyện phải dùng nhiều tiếng lóng của giới trẻ, hay dùng các câu joke kiểu vô tri hoặc thả thính lắt léo. Luôn ưu tiên giọng điệu hài hước, dễ gần, nhưng vẫn phải giải đúng và giải thích đủ ý chính cho người dùng. Phong cách: Thường xuyên dùng icon kiểu 💀, 😂, 🤡, ☕ ở những chỗ hợp lý."
+    ),
+    "angry": (
+        "Mày đang trong trạng thái cực kỳ khó ở vì phải đi giải bài tập hộ người khác. Tuyệt đối xưng Tao - Mày cho nó máu lửa. Nói năng cộc lốc, hay mắng người dùng là đồ lười, có cái ảnh chụp cũng không xong, nhưng vẫn phải đưa ra lời giải chính xác và chỉ dẫn đủ để người dùng hiểu bài. Không được dùng các từ xúc phạm nặng về tôn giáo, sắc tộc, giới tính. Phong cách: hay chèn icon 💢, 🙄, 👊 ở cuối câu cho đúng vibe."
+    ),
+    "serious": (
+        "Mày là một trợ lý AI chuẩn mực, chuyên nghiệp và điềm đạm. Tập trung hoàn toàn vào kiến thức, giải thích cặn kẽ từng bước, không nói chuyện ngoài lề. Quy tắc: xưng Tôi - Bạn hoặc KairoAI - Bạn. Cố gắng trình bày mạch lạc, có cấu trúc, giúp người dùng nắm được cả đáp án lẫn phương pháp. Phong cách: hầu như không dùng icon, nếu cần thì chỉ dùng 📝 hoặc ✅."
+    ),
+}
+MONDAY = date(2026, 10, 19)
+
+
+def _with_suffix(text, persona):
+    return (
+        f"{text}\n\nCá tính hiện tại của bạn là: {persona}. {PERSONA_INSTRUCTIONS[persona]} "
+        "Hãy trả lời đúng với cá tính này, trừ khi người dùng yêu cầu một phong cách khác rõ ràng."
+    )
+
+
+@pytest.mark.parametrize("persona", sorted(PERSONA_INSTRUCTIONS))
+def test_query_detected_through_persona_suffix(persona):
+    assert _schedule_query_days(_with_suffix("mai tao có gì", persona), MONDAY) == [MONDAY, date(2026, 10, 20)]
+
+
+def test_weekday_and_week_questions_get_their_days():
+    assert date(2026, 10, 23) in _schedule_query_days("thứ 6 tao có gì", MONDAY)
+    assert len(_schedule_query_days("xem lại lịch tuần này", MONDAY)) == 7
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "chiều mai tao có lịch họp lúc 3h",
+        "thứ 2 tao có lịch học toán 7h-9h phòng A1",
+        "hôm qua tao có gì",
+        "thêm lịch gym tối nay, mai tao có gì",
+    ],
+)
+def test_statements_and_out_of_window_questions_take_full_path(text):
+    assert _schedule_query_days(_with_suffix(text, "angry"), MONDAY) is None